@@ -0,0 +1,160 @@
+"""
+beijbom_benchmarks contains micro-benchmarks for the numeric kernels in beijbom_misc_tools, beijbom_caffe_tools and beijbom_confmatrix.
+The inputs are synthetic, at the sizes we use in practice, and caffe is not needed.
+
+Each benchmark runs in its own process, and records the median and min run time and the peak memory (on top of its inputs).
+Results are written to json and compared to a stored baseline. A benchmark regresses if its median time grows more than the threshold.
+
+Usage
+python beijbom_benchmarks.py --output bench.json --baseline bench_baseline.json
+python beijbom_benchmarks.py --baseline bench_baseline.json --update-baseline
+"""
+
+import sys, json, argparse, multiprocessing
+import numpy as np
+from timeit import default_timer as timer
+
+import beijbom_misc_tools as bmt
+from beijbom_confmatrix import ConfMatrix
+from beijbom_caffe_tools import Transformer
+
+
+def _survey_image(shape):
+    return np.random.randint(0, 256, tuple(shape) + (3, ), dtype = np.uint8)
+
+
+def _memory_kb(key):
+    """
+    Returns the VmRSS (current) or VmHWM (peak) memory of this process in kB, as reported by /proc/self/status.
+    """
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith(key + ':'):
+                return int(line.split()[1])
+
+
+def _labels(nclasses, n = 10**6):
+    gt = np.random.randint(0, nclasses, n)
+    est = np.where(np.random.rand(n) < 0.7, gt, np.random.randint(0, nclasses, n))
+    return (gt, est)
+
+
+def _benchmarks(quick = False):
+    """
+    Returns a list of (name, setup, kernel, repeats). setup() returns the inputs and kernel(inputs) is timed.
+    """
+    survey_shapes = [(4000, 4000)] if quick else [(4000, 4000), (8000, 16000)]
+    patch_sizes = [224, 448]
+    class_counts = [10, 100, 1000]
+
+    benchmarks = []
+    for ps in patch_sizes:
+        benchmarks.append(('crop_and_rotate_{}'.format(ps), lambda: _survey_image((2000, 2000)),
+            lambda im, ps = ps: bmt.crop_and_rotate(im, [1000, 1000], ps, 45), 50))
+        benchmarks.append(('tile_image_{}'.format(ps), lambda ps = ps: _survey_image((ps, ps)), bmt.tile_image, 50))
+        benchmarks.append(('transformer_preprocess_{}'.format(ps), lambda ps = ps: _survey_image((ps, ps)),
+            Transformer([104, 117, 123]).preprocess, 50))
+    for shape in survey_shapes:
+        name = '{}x{}'.format(*shape)
+        benchmarks.append(('slice_image_' + name, lambda shape = shape: _survey_image(shape), bmt.slice_image, 3))
+        benchmarks.append(('coral_image_resize_' + name, lambda shape = shape: _survey_image(shape),
+            lambda im: bmt.coral_image_resize(im, 'scale', 0.25, None), 3))
+    for nclasses in class_counts:
+        benchmarks.append(('confmatrix_add_{}'.format(nclasses), lambda nclasses = nclasses: (nclasses, _labels(nclasses)),
+            lambda (nclasses, labels): ConfMatrix(nclasses).add(*labels), 5))
+        benchmarks.append(('confmatrix_get_class_accuracy_{}'.format(nclasses), lambda nclasses = nclasses: ConfMatrix(nclasses).add(*_labels(nclasses)),
+            lambda cm: cm.get_class_accuracy(), 20))
+        benchmarks.append(('softmax_{}'.format(nclasses), lambda nclasses = nclasses: np.random.randn(256, nclasses), bmt.softmax, 50))
+    return benchmarks
+
+
+def _run_benchmark(setup, kernel, repeats, conn):
+    """
+    Runs in a child process. Sends a dict with the timings and peak memory back through conn.
+    """
+    np.random.seed(0)
+    inputs = setup()
+    # reset the peak memory so that it doesn't include temporaries from setup.
+    with open('/proc/self/clear_refs', 'w') as f:
+        f.write('5')
+    rss_inputs = _memory_kb('VmRSS')
+    times = []
+    for _ in range(repeats):
+        t0 = timer()
+        kernel(inputs)
+        times.append(timer() - t0)
+    rss_peak = _memory_kb('VmHWM')
+    conn.send({'time_median': float(np.median(times)), 'time_min': float(np.min(times)), 'repeats': repeats,
+        'peak_mb': (rss_peak - rss_inputs) / 1024.0})
+    conn.close()
+
+
+def run_benchmarks(quick = False, pattern = None):
+    """
+    Runs all benchmarks whose name contains pattern, each in a separate process. Returns a dict of name: results.
+    A benchmark that raises or is killed gets {'failed': True, 'exitcode': ...} as its results.
+    """
+    results = {}
+    for (name, setup, kernel, repeats) in _benchmarks(quick = quick):
+        if pattern is not None and not pattern in name:
+            continue
+        (parent_conn, child_conn) = multiprocessing.Pipe()
+        process = multiprocessing.Process(target = _run_benchmark, args = (setup, kernel, repeats, child_conn))
+        process.start()
+        child_conn.close() # so that recv() fails, instead of blocking, if the child dies without sending.
+        try:
+            results[name] = parent_conn.recv()
+        except EOFError:
+            results[name] = None
+        process.join()
+        if results[name] is None:
+            results[name] = {'failed': True, 'exitcode': process.exitcode}
+            print "{:<40} FAILED (exit code {})".format(name, process.exitcode)
+        else:
+            print "{:<40} {:>10.2f} ms {:>10.1f} MB".format(name, 1000 * results[name]['time_median'], results[name]['peak_mb'])
+    return results
+
+
+def compare_to_baseline(results, baseline, threshold = 0.2):
+    """
+    Returns a list of (name, baseline time, new time) for the benchmarks whose median time grew more than threshold (relative) from baseline.
+    """
+    regressions = []
+    for name, result in sorted(results.items()):
+        if result.get('failed') or baseline.get(name, {}).get('failed'):
+            continue
+        if name in baseline and result['time_median'] > (1 + threshold) * baseline[name]['time_median']:
+            regressions.append((name, baseline[name]['time_median'], result['time_median']))
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'Micro-benchmarks for the beijbom numeric kernels.')
+    parser.add_argument('--output', default = 'bench_output.json', help = 'file to write the results to.')
+    parser.add_argument('--baseline', default = None, help = 'baseline results to compare to.')
+    parser.add_argument('--update-baseline', action = 'store_true', help = 'write the results to the baseline file instead of comparing.')
+    parser.add_argument('--threshold', type = float, default = 0.2, help = 'allowed relative increase in median time.')
+    parser.add_argument('--quick', action = 'store_true', help = 'skip the largest inputs.')
+    parser.add_argument('--filter', default = None, help = 'only run benchmarks whose name contains this.')
+    args = parser.parse_args()
+
+    results = run_benchmarks(quick = args.quick, pattern = args.filter)
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent = 2, sort_keys = True)
+    failed = sorted([name for name, result in results.items() if result.get('failed')])
+    for name in failed:
+        print "FAILED {}".format(name)
+
+    if args.baseline is not None and args.update_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump(results, f, indent = 2, sort_keys = True)
+        sys.exit(1 if failed else 0)
+    elif args.baseline is not None:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare_to_baseline(results, baseline, threshold = args.threshold)
+        for (name, old, new) in regressions:
+            print "REGRESSION {}: {:.2f} ms -> {:.2f} ms".format(name, 1000 * old, 1000 * new)
+        sys.exit(1 if regressions or failed else 0)
+    else:
+        sys.exit(1 if failed else 0)
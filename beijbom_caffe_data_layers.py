@@ -2,18 +2,17 @@
 import os.path
 import json
 import time
-from random import shuffle
 from threading import Thread
 import numpy as np
-from PIL import Image
 from timeit import default_timer as timer
-import scipy.misc
-import skimage.io
 
 # own class imports
 import caffe
-from beijbom_misc_tools import crop_and_rotate, tile_image, coral_image_resize
+from beijbom_misc_tools import crop_and_rotate, tile_image, coral_image_resize, scipy_misc, DataCursor
 from beijbom_caffe_tools import Transformer
+from beijbom_confmatrix import ConfMatrix
+import beijbom_trace as trace
+from beijbom_image_source import get_source
 
 
 # ==============================================================================
@@ -78,7 +77,8 @@ class RandomPointDataLayer(caffe.Layer):
 
     def join_worker(self):
         assert self.thread is not None
-        self.thread.join()
+        with trace.span('RandomPointDataLayer.wait'):
+            self.thread.join()
         self.thread = None
 
 
@@ -92,55 +92,54 @@ class PatchBatchAdvancer():
     The PatchBatchAdvancer is a helper class to RandomPointDataLayer. It is called asychronosly and prepares the tops.
     """
     def __init__(self, result, params):
-        self._cur = 0
         self.result = result
         self.params = params
         self.imlist = [line.rstrip('\n') for line in open(params['imlistfile'])]
         with open(params['imdictfile']) as f:
             self.imdict = json.load(f)
         self.transformer = TransformerWrapper(params['im_mean'])
-        shuffle(self.imlist)
+        self.source = get_source(params)
+        self.cursor = DataCursor(len(self.imlist), params.get('seed'), params.get('cursorfile'))
 
         print "DataLayer initialized with {} images, {} imgs per batch, and {}x{} pixel patches".format(len(self.imlist), params['imgs_per_batch'], params['crop_size'], params['crop_size'])
 
+    @trace.traced('PatchBatchAdvancer')
     def __call__(self):
         t1 = timer()
         self.result['data'] = []
         self.result['label'] = []
 
-        if self._cur + self.params['imgs_per_batch'] >= len(self.imlist):
-            self._cur = 0
-            shuffle(self.imlist)
-        
-        # Grab images names from imlist
-        imnames = self.imlist[self._cur : self._cur + self.params['imgs_per_batch']]
+        # Grab images names from the seeded sampler, and start fetching them (and the next few, if they are remote).
+        (batch, rng) = self.cursor.next_batch()
+        nimgs = self.params['imgs_per_batch']
+        imnames = [self.imlist[i] for i in self.cursor.indices(batch * nimgs, nimgs)]
+        self.source.prefetch(imnames + [self.imlist[i] for i in self.cursor.indices((batch + 1) * nimgs, self.params.get('readahead', nimgs))])
 
         # Figure out how many patches to grab from each image
         patches_per_image = self.chunkify(self.params['batch_size'], self.params['imgs_per_batch'])
 
         # Make nice output string
-        output_str = [str(npatches) + ' from ' + os.path.basename(imname) + '(id ' + str(itt) + ')' for imname, npatches, itt in zip(imnames, patches_per_image, range(self._cur, self._cur + self.params['imgs_per_batch']))]
+        output_str = [str(npatches) + ' from ' + os.path.basename(imname) + '(id ' + str(itt) + ')' for imname, npatches, itt in zip(imnames, patches_per_image, range(batch * nimgs, (batch + 1) * nimgs))]
         
         # Loop over each image
         for imname, npatches in zip(imnames, patches_per_image):
-            self._cur += 1
 
             # randomly select the rotation angle for each patch             
-            angles = np.random.choice(360, size = npatches, replace = True)
+            angles = rng.choice(360, size = npatches, replace = True)
 
             # randomly select whether to flip this particular patch.
-            flips = np.round(np.random.rand(npatches))*2-1
+            flips = np.round(rng.rand(npatches))*2-1
 
             # get random offsets
-            rand_offsets = np.round(np.random.rand(npatches, 2) * (self.params['rand_offset'] * 2)  - self.params['rand_offset'])
+            rand_offsets = np.round(rng.rand(npatches, 2) * (self.params['rand_offset'] * 2)  - self.params['rand_offset'])
 
             # Randomly permute the patch list for this image. Sampling is done with replacement 
             # so that if we ask for more patches than is available, it still computes.
             (point_anns, height_cm) = self.imdict[os.path.basename(imname)] # read point annotations and image height in centimeters.
-            point_anns = [point_anns[pp] for pp in np.random.choice(len(point_anns), size = npatches, replace = True)]
+            point_anns = [point_anns[pp] for pp in rng.choice(len(point_anns), size = npatches, replace = True)]
 
             # Load image
-            im = np.asarray(Image.open(imname))
+            im = np.asarray(self.source.open(imname))
             (im, scale) = coral_image_resize(im, self.params['scaling_method'], self.params['scaling_factor'], height_cm) #resize.
 
             # Pad the boundaries
@@ -160,7 +159,7 @@ class PatchBatchAdvancer():
         """
         lst = range(k)
         return [ len(lst[i::n]) for i in xrange(n) ]
-        
+
 
 class TransformerWrapper(Transformer):
     def __init__(self, mean):
@@ -170,6 +169,141 @@ class TransformerWrapper(Transformer):
 
 
 
+# ==============================================================================
+# ==============================================================================
+# ========================= MULTI SCALE RANDOM POINT LAYER =====================
+# ==============================================================================
+# ==============================================================================
+
+class MultiScalePointDataLayer(caffe.Layer):
+    """
+    MultiScalePointDataLayer works like RandomPointDataLayer, but samples the same points at several scales.
+    Each image is decoded once per batch and resized to each scale in params['scaling_factors'], with patches of the corresponding size in params['crop_sizes'].
+    Tops are data_0, ..., data_{nscales-1}, label. The label is shared across the scales.
+    """
+
+    def setup(self, bottom, top):
+
+        # === Read input parameters ===
+        params = eval(self.param_str)
+        assert 'batch_size' in params.keys(), 'Params must include batch size.'
+        assert 'imlistfile' in params.keys(), 'Params must include imlistfile.'
+        assert 'imdictfile' in params.keys(), 'Params must include imdictfile.'
+        assert 'imgs_per_batch' in params.keys(), 'Params must include imgs_per_batch.'
+        assert 'crop_sizes' in params.keys(), 'Params must include crop_sizes.'
+        assert 'scaling_method' in params.keys(), 'Params must include scaling_method'
+        assert 'scaling_factors' in params.keys(), 'Params must include scaling_factors'
+        assert 'im_mean' in params.keys(), 'Params must include im_mean.'
+        assert 'rand_offset' in params.keys(), 'Params must include rand_offset.'
+        assert len(params['crop_sizes']) == len(params['scaling_factors']), 'Params crop_sizes and scaling_factors must have the same length.'
+
+        self.batch_size = params['batch_size']
+        self.top_names = ['data_{}'.format(i) for i in range(len(params['scaling_factors']))] + ['label']
+        assert len(top) == len(self.top_names), 'Layer must have {} tops.'.format(len(self.top_names))
+
+        # === Check some of the input variables
+        imlist = [line.rstrip('\n') for line in open(params['imlistfile'])]
+        assert len(imlist) >= params['imgs_per_batch'], 'Image list must be longer than the number of images you ask for per batch.'
+        assert params['scaling_method'] in ('ratio', 'scale')
+
+        # === set up thread and batch advancer ===
+        self.thread_result = {}
+        self.thread = None
+        self.batch_advancer = MultiScalePatchBatchAdvancer(self.thread_result, params)
+        self.dispatch_worker()
+
+        # === reshape tops ===
+        for top_index, crop_size in enumerate(params['crop_sizes']):
+            top[top_index].reshape(self.batch_size, 3, crop_size, crop_size)
+        top[-1].reshape(self.batch_size, 1)
+
+    def reshape(self, bottom, top):
+        """ happens during setup """
+        pass
+
+    def forward(self, bottom, top):
+        if self.thread is not None:
+            self.join_worker()
+
+        for top_index, name in zip(range(len(top)), self.top_names):
+            for i in range(self.batch_size):
+                top[top_index].data[i, ...] = self.thread_result[name][i]
+        self.dispatch_worker()
+
+    def dispatch_worker(self):
+        assert self.thread is None
+        self.thread = Thread(target=self.batch_advancer)
+        self.thread.start()
+
+    def join_worker(self):
+        assert self.thread is not None
+        with trace.span('MultiScalePointDataLayer.wait'):
+            self.thread.join()
+        self.thread = None
+
+
+    def backward(self, top, propagate_down, bottom):
+        """ this layer does not back propagate """
+        pass
+
+
+class MultiScalePatchBatchAdvancer(PatchBatchAdvancer):
+    """
+    The MultiScalePatchBatchAdvancer is a helper class to MultiScalePointDataLayer. It is called asychronosly and prepares the tops.
+    """
+    def __init__(self, result, params):
+        self.result = result
+        self.params = params
+        self.imlist = [line.rstrip('\n') for line in open(params['imlistfile'])]
+        with open(params['imdictfile']) as f:
+            self.imdict = json.load(f)
+        self.transformer = TransformerWrapper(params['im_mean'])
+        self.source = get_source(params)
+        self.cursor = DataCursor(len(self.imlist), params.get('seed'), params.get('cursorfile'))
+
+        print "MultiScaleDataLayer initialized with {} images, {} imgs per batch, scaling factors {} and crop sizes {}".format(len(self.imlist), params['imgs_per_batch'], params['scaling_factors'], params['crop_sizes'])
+
+    @trace.traced('MultiScalePatchBatchAdvancer')
+    def __call__(self):
+        nscales = len(self.params['scaling_factors'])
+        for i in range(nscales):
+            self.result['data_{}'.format(i)] = []
+        self.result['label'] = []
+
+        # Grab images names from the seeded sampler, and start fetching them (and the next few, if they are remote).
+        (batch, rng) = self.cursor.next_batch()
+        nimgs = self.params['imgs_per_batch']
+        imnames = [self.imlist[i] for i in self.cursor.indices(batch * nimgs, nimgs)]
+        self.source.prefetch(imnames + [self.imlist[i] for i in self.cursor.indices((batch + 1) * nimgs, self.params.get('readahead', nimgs))])
+
+        # Figure out how many patches to grab from each image
+        patches_per_image = self.chunkify(self.params['batch_size'], self.params['imgs_per_batch'])
+
+        # Loop over each image
+        for imname, npatches in zip(imnames, patches_per_image):
+
+            # draw the augmentation parameters once, so that they are the same at all scales.
+            angles = rng.choice(360, size = npatches, replace = True)
+            flips = np.round(rng.rand(npatches))*2-1
+            rand_offsets = np.round(rng.rand(npatches, 2) * (self.params['rand_offset'] * 2)  - self.params['rand_offset'])
+            (point_anns, height_cm) = self.imdict[os.path.basename(imname)] # read point annotations and image height in centimeters.
+            point_anns = [point_anns[pp] for pp in rng.choice(len(point_anns), size = npatches, replace = True)]
+
+            # Load image once, and extract the patches at each scale from it.
+            im_org = np.asarray(self.source.open(imname))
+            for i, (scaling_factor, crop_size) in enumerate(zip(self.params['scaling_factors'], self.params['crop_sizes'])):
+                (im, scale) = coral_image_resize(im_org, self.params['scaling_method'], scaling_factor, height_cm) #resize.
+                im = np.pad(im, ((crop_size * 2, crop_size * 2),(crop_size * 2, crop_size * 2), (0, 0)), mode='reflect')
+                for ((row, col, label), angle, flip, rand_offset) in zip(point_anns, angles, flips, rand_offsets):
+                    center_org = np.asarray([row, col])
+                    center = np.round(crop_size * 2 + center_org * scale + rand_offset).astype(np.int)
+                    patch = self.transformer(crop_and_rotate(im, center, crop_size, angle, tile = False))
+                    self.result['data_{}'.format(i)].append(patch[::flip, :, :])
+
+            self.result['label'].extend([label for (row, col, label) in point_anns])
+
+
+
 
 
 
@@ -235,7 +369,8 @@ class ImageNetDataLayer(caffe.Layer):
 
     def join_worker(self):
         assert self.thread is not None
-        self.thread.join()
+        with trace.span('ImageNetDataLayer.wait'):
+            self.thread.join()
         self.thread = None
 
 
@@ -249,57 +384,57 @@ class ImageNetPatchBatchAdvancer():
     The ImageNetPatchBatchAdvancer is a helper class to ImageNetDataLayer. It is called asychronosly and prepares the tops.
     """
     def __init__(self, result, params):
-        self._cur = 0
         self.result = result
         self.params = params
         self.imlist = [line.rstrip('\n') for line in open(params['imlistfile'])]
         with open(params['imdictfile']) as f:
             self.imdict = json.load(f)
         self.transformer = TransformerWrapper(params['im_mean'])
-        shuffle(self.imlist)
+        self.source = get_source(params)
+        self.cursor = DataCursor(len(self.imlist), params.get('seed'), params.get('cursorfile'))
 
         print "DataLayer initialized with {} images".format(len(self.imlist))
 
+    @trace.traced('ImageNetPatchBatchAdvancer')
     def __call__(self):
         self.result['data'] = []
         self.result['label'] = []
 
-        if self._cur + self.params['batch_size'] >= len(self.imlist):
-            self._cur = 0
-            shuffle(self.imlist)
-        
-        # Loop over each image
-        for imname in self.imlist[self._cur : self._cur + self.params['batch_size']]:
-            self._cur += 1
+        (batch, rng) = self.cursor.next_batch()
+        nimgs = self.params['batch_size']
+        imnames = [self.imlist[i] for i in self.cursor.indices(batch * nimgs, nimgs)]
+        self.source.prefetch(imnames + [self.imlist[i] for i in self.cursor.indices((batch + 1) * nimgs, self.params.get('readahead', nimgs))])
 
-            im = Image.open(imname) # Load image
+        # Loop over each image
+        for imname in imnames:
+            im = self.source.open(imname) # Load image
             im = im.convert("RGB") # make sure it's 3 channels
-            im = self.scale_augment(im) # scale augmentation
+            im = self.scale_augment(im, rng) # scale augmentation
 
 			# random crop
             (width, height) = im.size
-            left = np.random.choice(width - 224)
-            upper = np.random.choice(height - 224)
+            left = rng.choice(width - 224)
+            upper = rng.choice(height - 224)
             im = im.crop((left, upper, left + 224, upper + 224))
             im = np.asarray(im)
            
 			# random flip 
-            flip = np.random.choice(2)*2-1
+            flip = rng.choice(2)*2-1
             im = im[:, ::flip, :]
                 
             self.result['data'].append(self.transformer(im)            )
             self.result['label'].append(self.imdict[os.path.basename(imname)])
 
-    def scale_augment(self, im):
+    def scale_augment(self, im, rng = np.random):
         (width, height) = im.size
         width, height = float(width), float(height)
         if width <= height:
             wh_ratio = height / width
-            new_width = int(np.random.choice(480-256) + 256)
+            new_width = int(rng.choice(480-256) + 256)
             im = im.resize((new_width, int(new_width * wh_ratio)))
         else:
             hw_ratio = width / height
-            new_height = int(np.random.choice(480-256) + 256)
+            new_height = int(rng.choice(480-256) + 256)
             im = im.resize((int(new_height * hw_ratio), new_height))
         return im
     
@@ -376,7 +511,7 @@ class RandomPointRegressionDataLayer(caffe.Layer):
         # === set up thread and batch advancer ===
         self.thread_result = {}
         self.thread = None
-        self.batch_advancer = RegressionBatchAdvancer(self.thread_result, self.batch_size, imlist, imdict, transformer, self.nclasses, self.im_shape)
+        self.batch_advancer = RegressionBatchAdvancer(self.thread_result, self.batch_size, imlist, imdict, transformer, self.nclasses, self.im_shape, source = get_source(params), readahead = params.get('readahead', 8), seed = params.get('seed'), cursorfile = params.get('cursorfile'))
         self.dispatch_worker()
 
         # === reshape tops ===
@@ -409,7 +544,8 @@ class RandomPointRegressionDataLayer(caffe.Layer):
 
     def join_worker(self):
         assert self.thread is not None
-        self.thread.join()
+        with trace.span('RandomPointRegressionDataLayer.wait'):
+            self.thread.join()
         self.thread = None
 
 
@@ -422,34 +558,34 @@ class RegressionBatchAdvancer():
     """
     The RegressionBatchAdvancer is a helper class to RandomPointRegressionDataLayer. It is called asychronosly and prepares the tops.
     """
-    def __init__(self, result, batch_size, imlist, imdict, transformer, nclasses, im_shape):
+    def __init__(self, result, batch_size, imlist, imdict, transformer, nclasses, im_shape, source = None, readahead = 8, seed = None, cursorfile = None):
         self.result = result
+        self.source = get_source() if source is None else source
+        self.readahead = readahead
         self.batch_size = batch_size
         self.imlist = imlist
         self.imdict = imdict
         self.transformer = transformer
-        self._cur = 0
         self.nclasses = nclasses
         self.im_shape = im_shape
-        shuffle(self.imlist)
+        self.cursor = DataCursor(len(self.imlist), seed, cursorfile)
 
         print "RegressionBatchAdvancer is initialized with {} images".format(len(imlist))
 
+    @trace.traced('RegressionBatchAdvancer')
     def __call__(self):
         
         t0 = timer()
         self.result['data'] = []
         self.result['label'] = []
 
-        if self._cur == len(self.imlist):
-            self._cur = 0
-            shuffle(self.imlist)
-        
-        imname = self.imlist[self._cur]
+        (batch, rng) = self.cursor.next_batch()
+        imname = self.imlist[self.cursor.indices(batch, 1)[0]]
+        self.source.prefetch([imname] + [self.imlist[i] for i in self.cursor.indices(batch + 1, self.readahead)])
 
         # Load image
-        im = np.asarray(Image.open(imname))
-        im = scipy.misc.imresize(im, self.im_shape)
+        im = np.asarray(self.source.open(imname))
+        im = scipy_misc.imresize(im, self.im_shape)
         point_anns = self.imdict[os.path.basename(imname)][0]
 
         class_hist = np.zeros(self.nclasses).astype(np.float32)
@@ -460,8 +596,7 @@ class RegressionBatchAdvancer():
                 
         self.result['data'].append(self.transformer.preprocess(im))
         self.result['label'].append(class_hist)
-        self._cur += 1
-        # print "loaded image {} in {} secs.".format(self._cur, timer() - t0)
+        # print "loaded image {} in {} secs.".format(batch, timer() - t0)
 
 
 # ==============================================================================
@@ -502,7 +637,7 @@ class RandomPointMultiLabelDataLayer(caffe.Layer):
         # === set up thread and batch advancer ===
         self.thread_result = {}
         self.thread = None
-        self.batch_advancer = MultiLabelBatchAdvancer(self.thread_result, self.batch_size, imlist, imdict, transformer, self.nclasses, self.im_shape)
+        self.batch_advancer = MultiLabelBatchAdvancer(self.thread_result, self.batch_size, imlist, imdict, transformer, self.nclasses, self.im_shape, source = get_source(params), readahead = params.get('readahead', 8), seed = params.get('seed'), cursorfile = params.get('cursorfile'))
         self.dispatch_worker()
 
         # === reshape tops ===
@@ -533,7 +668,8 @@ class RandomPointMultiLabelDataLayer(caffe.Layer):
 
     def join_worker(self):
         assert self.thread is not None
-        self.thread.join()
+        with trace.span('RandomPointMultiLabelDataLayer.wait'):
+            self.thread.join()
         self.thread = None
 
 
@@ -546,34 +682,34 @@ class MultiLabelBatchAdvancer():
     """
     The MultiLabelBatchAdvancer is a helper class to RandomPointRegressionDataLayer. It is called asychronosly and prepares the tops.
     """
-    def __init__(self, result, batch_size, imlist, imdict, transformer, nclasses, im_shape):
+    def __init__(self, result, batch_size, imlist, imdict, transformer, nclasses, im_shape, source = None, readahead = 8, seed = None, cursorfile = None):
         self.result = result
+        self.source = get_source() if source is None else source
+        self.readahead = readahead
         self.batch_size = batch_size
         self.imlist = imlist
         self.imdict = imdict
         self.transformer = transformer
-        self._cur = 0
         self.nclasses = nclasses
         self.im_shape = im_shape
-        shuffle(self.imlist)
+        self.cursor = DataCursor(len(self.imlist), seed, cursorfile)
 
         print "MultiLabelBatchAdvancer is initialized with {} images".format(len(imlist))
 
+    @trace.traced('MultiLabelBatchAdvancer')
     def __call__(self):
         
         t0 = timer()
         self.result['data'] = []
         self.result['label'] = []
 
-        if self._cur == len(self.imlist):
-            self._cur = 0
-            shuffle(self.imlist)
-        
-        imname = self.imlist[self._cur]
+        (batch, rng) = self.cursor.next_batch()
+        imname = self.imlist[self.cursor.indices(batch, 1)[0]]
+        self.source.prefetch([imname] + [self.imlist[i] for i in self.cursor.indices(batch + 1, self.readahead)])
 
         # Load image
-        im = np.asarray(Image.open(imname))
-        im = scipy.misc.imresize(im, self.im_shape)
+        im = np.asarray(self.source.open(imname))
+        im = scipy_misc.imresize(im, self.im_shape)
         point_anns = self.imdict[os.path.basename(imname)][0]
 
         class_in_image = np.zeros(self.nclasses).astype(np.float32)
@@ -583,5 +719,100 @@ class MultiLabelBatchAdvancer():
                 
         self.result['data'].append(self.transformer.preprocess(im))
         self.result['label'].append(class_in_image)
-        self._cur += 1
-        # print "loaded image {} in {} secs.".format(self._cur, timer() - t0)
+        # print "loaded image {} in {} secs.".format(batch, timer() - t0)
+
+
+# ==============================================================================
+# ==============================================================================
+# ========================= CONFUSION MATRIX LAYER =============================
+# ==============================================================================
+# ==============================================================================
+
+class ConfMatrixLayer(caffe.Layer):
+    """
+    ConfMatrixLayer accumulates a confusion matrix from the score and label bottoms during each test phase, and writes it to disk at the end of the phase.
+    This gives the full per-class evaluation at every test_interval, without a separate classify pass.
+
+    Params
+    nclasses: number of classes.
+    test_iter: number of forward passes per test phase. Must be the same as test_iter in the solver.
+    ignore_label: (optional) label to ignore, e.g. for FCN nets.
+    test_interval: (optional) if given, the output files are named by training iteration, otherwise by the test phase count.
+    test_initialization: (optional, default False) must be the same as test_initialization in the solver, i.e. whether there is a test phase at iteration 0.
+    start_iter: (optional) the iteration caffe starts (or resumes) at. Defaults to the last iter in {prefix}_metrics.txt, or 0 if there is none, which assumes that caffe resumes from a snapshot of the last tested iteration (as with run and cycle_runs, if the cycles are multiples of test_interval).
+    outdir: (optional, default '.') directory to write to.
+    prefix: (optional, default 'confmatrix') prefix of the output files.
+
+    Bottoms are score (N x C or N x C x H x W) and label (N x 1 or N x 1 x H x W). If the layer has a top, it is set to the running accuracy.
+    After each test phase, the matrix is written to {prefix}_iter_{iter}.cm (see ConfMatrix.load), and accuracy, kappa and mean recall are appended as a json line to {prefix}_metrics.txt.
+    """
+
+    def setup(self, bottom, top):
+
+        # === Read input parameters ===
+        params = eval(self.param_str)
+        assert 'nclasses' in params.keys(), 'Params must include nclasses.'
+        assert 'test_iter' in params.keys(), 'Params must include test_iter.'
+        assert len(bottom) == 2, 'Layer must have two bottoms: score and label.'
+        assert len(top) <= 1, 'Layer can have at most one top.'
+
+        self.nclasses = params['nclasses']
+        self.test_iter = params['test_iter']
+        self.ignore_label = params.get('ignore_label', None)
+        self.test_interval = params.get('test_interval', None)
+        self.outdir = params.get('outdir', '.')
+        self.prefix = params.get('prefix', 'confmatrix')
+        test_initialization = params.get('test_initialization', False)
+
+        # caffe restarts from a snapshot in each cycle of cycle_runs, so continue the numbering of the earlier runs.
+        start_iter = params.get('start_iter', None)
+        metricsfile = os.path.join(self.outdir, '{}_metrics.txt'.format(self.prefix))
+        if start_iter is None:
+            start_iter = 0
+            if os.path.isfile(metricsfile):
+                with open(metricsfile) as f:
+                    lines = [line for line in f if line.strip()]
+                if lines:
+                    start_iter = json.loads(lines[-1])['iter']
+
+        # caffe tests when iter is a multiple of test_interval, except at iteration 0 without test_initialization.
+        if self.test_interval:
+            tested_at_start = start_iter % self.test_interval == 0 and (start_iter > 0 or test_initialization)
+            self.next_iter = start_iter if tested_at_start else (start_iter // self.test_interval + 1) * self.test_interval
+        else:
+            self.next_iter = start_iter + 1
+
+        self.cm = ConfMatrix(self.nclasses)
+        self.nforward = 0
+
+    def reshape(self, bottom, top):
+        if len(top) > 0:
+            top[0].reshape(1)
+
+    def forward(self, bottom, top):
+        est = np.argmax(bottom[0].data, axis = 1)
+        gt = bottom[1].data.reshape(est.shape)
+        self.cm.add(gt, est, ignore_label = self.ignore_label)
+        self.nforward += 1
+        if len(top) > 0:
+            top[0].data[0] = self.cm.get_accuracy()[0]
+
+        if self.nforward == self.test_iter:
+            self.write()
+            self.cm = ConfMatrix(self.nclasses)
+            self.nforward = 0
+
+    def write(self):
+        """ writes the confusion matrix and summary metrics of the current test phase. """
+        itt = self.next_iter
+        self.next_iter += self.test_interval if self.test_interval else 1
+        self.cm.save(os.path.join(self.outdir, '{}_iter_{}.cm'.format(self.prefix, itt)))
+        (acc, kappa) = self.cm.get_accuracy()
+        metrics = {'iter': itt, 'accuracy': float(acc), 'kappa': float(kappa), 'mean_recall': float(np.mean(self.cm.get_class_recalls())), 'count': int(self.cm.total())}
+        with open(os.path.join(self.outdir, '{}_metrics.txt'.format(self.prefix)), 'a') as f:
+            f.write(json.dumps(metrics) + '\n')
+        print "ConfMatrixLayer, iter {}: accuracy {:.3f}, kappa {:.3f}, mean recall {:.3f}".format(itt, acc, kappa, metrics['mean_recall'])
+
+    def backward(self, top, propagate_down, bottom):
+        """ this layer does not back propagate """
+        pass
@@ -1,16 +1,22 @@
-import glob, os, math, colorsys, scipy, caffe, re, sys
+import glob, os, math, re, sys, json, time, multiprocessing, hashlib, shutil
+from Queue import Empty
 from PIL import Image
 import numpy as np
-import matplotlib.pyplot as plt
 import beijbom_misc_tools as bmt
 import beijbom_confmatrix as confmatrix
-from pylab import *
+import beijbom_trace as trace
 from copy import deepcopy, copy
-import cPickle as pickle
-from tqdm import tqdm
+from contextlib import contextmanager
+from timeit import default_timer as timer
 from settings import CAFFEPATH
-from caffe import layers as L, params as P
-from beijbom_misc_tools import coral_image_resize, crop_and_rotate
+from beijbom_misc_tools import coral_image_resize, crop_variants, LazyModule
+from beijbom_image_source import get_source
+
+# caffe and tqdm are imported on first use, so the numpy parts of this module (e.g. Transformer) can be used without them.
+caffe = LazyModule('caffe')
+L = LazyModule('caffe', 'layers')
+P = LazyModule('caffe', 'params')
+tqdm = LazyModule('tqdm', 'tqdm')
 
 """
 beijbom_caffe_tools (bct) contains classes and wrappers for caffe.
@@ -37,6 +43,7 @@ class Transformer:
         """
         self.scale = scale
 
+    @trace.traced('Transformer.preprocess')
     def preprocess(self, im):
         """
         preprocess() emulate the pre-processing occuring in the vgg16 caffe prototxt.
@@ -50,6 +57,7 @@ class Transformer:
         
         return im
 
+    @trace.traced('Transformer.deprocess')
     def deprocess(self, im):
         """
         inverse of preprocess()
@@ -132,7 +140,8 @@ class CaffeSolver:
 
 
 
-def run(workdir = None, caffemodel = None, GPU_id = 0, solverfile = 'solver.prototxt', log = 'train.log', snapshot_prefix = 'snapshot', caffepath = CAFFEPATH, restart = False, nbr_iters = None):
+@trace.traced('run')
+def run(workdir = None, caffemodel = None, GPU_id = 0, solverfile = 'solver.prototxt', log = 'train.log', snapshot_prefix = 'snapshot', caffepath = CAFFEPATH, restart = False, nbr_iters = None, cursorfile = 'data_cursor.json'):
     """
     run is a simple caffe wrapper for training nets. It basically does two things. (1) ensures that training continues from the most recent model, and (2) makes sure the output is captured in a log file.
 
@@ -144,6 +153,7 @@ def run(workdir = None, caffemodel = None, GPU_id = 0, solverfile = 'solver.prot
     snapshot_prefix: snapshot prefix. 
     caffepath: path the caffe binaries. This is required since we make a system call to caffe.
     restart: determines whether to restart even if there are snapshots in the directory.
+    cursorfile: the cursorfile of the (train) data layer, relative to workdir. If it exists, it is set to continue the data stream where the snapshot left it (or from the start when not resuming). See DataCursor in beijbom_misc_tools.
 
     """
 
@@ -170,6 +180,13 @@ def run(workdir = None, caffemodel = None, GPU_id = 0, solverfile = 'solver.prot
         solver.sp['snapshot'] = str(1000000) #disable this, don't need it.
         solver.write(os.path.join(workdir, solverfile))
 
+    # continue the data stream of the seeded data layers where the snapshot left it.
+    if os.path.isfile(os.path.join(workdir, cursorfile)):
+        solver = CaffeSolver()
+        solver.add_from_file(os.path.join(workdir, solverfile))
+        resume_batch = max_iter * int(solver.sp.get('iter_size', '1')) if snapshots and not(restart) else 0
+        bmt.DataCursor.set_batch(os.path.join(workdir, cursorfile), resume_batch)
+
     print caffepath
     # by default, start from the most recent snapshot
     if snapshots and not(restart): 
@@ -193,7 +210,8 @@ def run(workdir = None, caffemodel = None, GPU_id = 0, solverfile = 'solver.prot
 
 
 
-def classify(workdir, scorelayer, caffemodel = None, GPU_id = 0, labellayer = 'label', snapshot_prefix = 'snapshot', net_prototxt = 'net.prototxt', save = False, ignore_label = np.inf, n_testinstances = None, batch_size = None):
+@trace.traced('classify')
+def classify(workdir, scorelayer, caffemodel = None, GPU_id = 0, labellayer = 'label', snapshot_prefix = 'snapshot', net_prototxt = 'net.prototxt', save = False, ignore_label = np.inf, n_testinstances = None, batch_size = None, fcn_confmatrix = False, keep_maps = False, score_rate = 0):
     """
     classify runs a trained net on a testset defined in a net.prototxt file and returns the ground truth, estimated labels and the score vectors.
 
@@ -206,9 +224,13 @@ def classify(workdir, scorelayer, caffemodel = None, GPU_id = 0, labellayer = 'l
     save: wheather to save the output to disk.
     ignore_label: Ignores all labels where the gt = ignore_label. Relevant only for FCN models. 
     n_testinstances: Number of instances in the test list. If not given, this will be extracted automatically from the testlist or LMDB. 
+    fcn_confmatrix: For FCN models. If True, the pixels are not returned one by one, but accumulated in a confusion matrix batch by batch, so that memory stays constant with the size of the test set.
+    keep_maps: Only with fcn_confmatrix. Whether to also return the estimated label map of each test image.
+    score_rate: Only with fcn_confmatrix. Fraction of the (non-ignored) pixels for which to return the scores.
 
     Gives
     (gt, est, scores): tuple with ground truth (as list), estimated labels (as list), scores as list of np arrays
+    or, with fcn_confmatrix, (cm, maps, (gt, scores)): ConfMatrix of all non-ignored pixels, list of uint16 label maps (empty unless keep_maps) and the ground truth and scores of the sampled pixels as arrays.
 
     """
 
@@ -246,6 +268,10 @@ def classify(workdir, scorelayer, caffemodel = None, GPU_id = 0, labellayer = 'l
     # Load model
     net = load_model(workdir, caffemodel, GPU_id = GPU_id, net_prototxt = net_prototxt)
 
+    if fcn_confmatrix and net.blobs[labellayer].data.ndim > 1:
+        return _classify_fcn_confmatrix(net, n_testinstances, batch_size, scorelayer, labellayer, ignore_label, keep_maps, score_rate,
+            os.path.join(workdir, 'confmatrix_on_' + test_file[5:] + '_using_' + caffemodel) if save else None)
+
     # Classify. All the reshaping has to do with being able to handling both FCN and classification nets.
     gtlist = []
     scorelist = []
@@ -263,7 +289,8 @@ def classify(workdir, scorelayer, caffemodel = None, GPU_id = 0, labellayer = 'l
             scorelist.extend(list(np.reshape(scores, [scores.shape[0]/nclasses, nclasses])))
             gt = gt[keepind]
             gtlist.extend(list(np.reshape(gt, [gt.shape[0]/nclasses, nclasses])[:, 0]))
-        net.forward()
+        with trace.span('classify.forward', batch = test_itt):
+            net.forward()
 
     # If the net is not a FCN we need to cut of the lists (since the last iteration may be looping around)
     if net.blobs[labellayer].data.ndim == 1: 
@@ -273,13 +300,154 @@ def classify(workdir, scorelayer, caffemodel = None, GPU_id = 0, labellayer = 'l
     # For convenience, include estimated labels
     estlist = [np.argmax(s) for s in scorelist]
     if (save):
-        pickle.dump((gtlist, estlist, scorelist), open(os.path.join(workdir, 'predictions_on_' + test_file[5:] + '_using_' + caffemodel +  '.p'), 'wb'))
+        bmt.psave((gtlist, estlist, scorelist), os.path.join(workdir, 'predictions_on_' + test_file[5:] + '_using_' + caffemodel +  '.p'))
 
     return (gtlist, estlist, scorelist)
 
+def _classify_fcn_confmatrix(net, n_testinstances, batch_size, scorelayer, labellayer, ignore_label, keep_maps, score_rate, savename):
+    """
+    FCN branch of classify with fcn_confmatrix = True. Only the argmax of each batch is computed, and added to a confusion matrix.
+    """
+    ignore = None if np.isinf(ignore_label) else ignore_label
+    cm = confmatrix.ConfMatrix(net.blobs[scorelayer].data.shape[1])
+    (maps, gt_samples, score_samples) = ([], [], [])
+    rng = np.random.RandomState(0)
+    for test_itt in tqdm(range(int(math.ceil(float(n_testinstances) / batch_size)))):
+        nvalid = min(batch_size, n_testinstances - test_itt * batch_size) # the last batch loops around to the start.
+        gt = net.blobs[labellayer].data[:nvalid, 0]
+        scores = net.blobs[scorelayer].data[:nvalid]
+        est = np.argmax(scores, axis = 1)
+        cm.add(gt, est, ignore_label = ignore)
+        if keep_maps:
+            maps.extend(list(est.astype(np.uint16)))
+        if score_rate > 0:
+            (n, row, col) = np.nonzero((gt != ignore_label) & (rng.rand(*gt.shape) < score_rate))
+            gt_samples.append(gt[n, row, col].astype(np.int64))
+            score_samples.append(scores[n, :, row, col].astype(np.float32))
+        with trace.span('classify.forward', batch = test_itt):
+            net.forward()
+
+    nclasses = cm.nclasses
+    sampled = (np.concatenate(gt_samples) if gt_samples else np.zeros(0, dtype = np.int64), np.concatenate(score_samples) if score_samples else np.zeros((0, nclasses), dtype = np.float32))
+    if savename is not None:
+        cm.save(savename + '.cm')
+        if keep_maps or score_rate > 0:
+            bmt.psave((maps, sampled), savename + '.p')
+    return (cm, maps, sampled)
+
+
+# cycle_runs has an argument named classify, so it calls the function through this alias.
+_classify = classify
+
+
+
+class SolverSession(object):
+    """
+    SolverSession keeps a caffe solver alive in this process, so that it can be trained in several steps (e.g. the cycles of cycle_runs) without restarting caffe, reloading the snapshot and re-running the setup of the data layers.
+    It resumes like run: from the latest solverstate in workdir, else from caffemodel (or the *initial.caffemodel), else from scratch. Like run, it sets cursorfile (relative to workdir, if it exists) so that the data stream continues where the solverstate left it.
+    Snapshots are only written by snapshot() and close(), and the test nets only run on test().
+
+    NOTE: each session holds its nets (and data layer threads) in memory, on the device it was created on. The caffe log goes to stderr, not to a log file.
+    The session only works in workdir during its calls, while the data layers prefetch the next batch in between, so their image paths should be absolute.
+    """
+
+    def __init__(self, workdir, solverfile = 'solver.prototxt', caffemodel = None, GPU_id = 0, snapshot_prefix = 'snapshot', restart = False, cursorfile = 'data_cursor.json'):
+        self.workdir = os.path.abspath(workdir)
+        self.GPU_id = GPU_id
+        with self._selected():
+            # The session runs a copy of the solver, without automatic snapshots and tests.
+            solver = CaffeSolver()
+            solver.add_from_file(solverfile)
+            with open(solverfile) as f:
+                self.test_iters = [int(t) for t in re.findall('test_iter:\s*([0-9]+)', f.read())]
+            solver.sp['snapshot'] = '0'
+            solver.sp['test_interval'] = str(10**9)
+            solver.sp['test_initialization'] = 'false'
+            solver.write('session_' + solverfile)
+
+            snapshots = glob.glob("{}*.solverstate".format(snapshot_prefix))
+            _iter = [int(s[s.index('iter_')+5:s.index('.')]) for s in snapshots]
+            # the data layers read the cursorfile when the solver is created, and solver.restore does not reset it.
+            if os.path.isfile(cursorfile):
+                resume_batch = np.max(_iter) * int(solver.sp.get('iter_size', '1')) if snapshots and not(restart) else 0
+                bmt.DataCursor.set_batch(cursorfile, resume_batch)
+            self.solver = caffe.get_solver('session_' + solverfile)
+
+            if not caffemodel:
+                caffemodel = glob.glob("*initial.caffemodel")
+                caffemodel = caffemodel[0] if caffemodel else None
+            if snapshots and not(restart):
+                print "Session for {} resumes from iter {}.".format(workdir, np.max(_iter))
+                self.solver.restore(snapshots[np.argmax(_iter)])
+            elif caffemodel:
+                print "Session for {} fine tunes from {}.".format(workdir, caffemodel)
+                self.solver.net.copy_from(caffemodel)
+            else:
+                print "Session for {} starts from scratch!!".format(workdir)
+            self._snapshot_iter = self.solver.iter
+
+    @contextmanager
+    def _selected(self):
+        """
+        Moves to the workdir and device of this session, since caffe paths and mode are global. The working directory is restored on exit.
+        """
+        cwd = os.getcwd()
+        os.chdir(self.workdir)
+        try:
+            if self.GPU_id is None:
+                caffe.set_mode_cpu()
+            else:
+                caffe.set_device(self.GPU_id)
+                caffe.set_mode_gpu()
+            yield
+        finally:
+            os.chdir(cwd)
+
+    def step(self, niter):
+        """
+        Trains for niter iterations.
+        """
+        with self._selected(), trace.span('SolverSession.step', workdir = self.workdir, niter = niter):
+            self.solver.step(niter)
+
+    def test(self):
+        """
+        Runs each test net for its test_iter iterations (from the solver prototxt), with the current weights.
+
+        Gives
+        list with one dict per test net, mapping each output blob (e.g. 'loss', 'accuracy') to its mean over the iterations.
+        """
+        results = []
+        for k, test_net in enumerate(self.solver.test_nets):
+            test_net.share_with(self.solver.net)
+            test_iter = self.test_iters[min(k, len(self.test_iters) - 1)] if self.test_iters else 1
+            sums = {}
+            with self._selected(), trace.span('SolverSession.test', workdir = self.workdir, net = k):
+                for _ in range(test_iter):
+                    for (name, blob) in test_net.forward().items():
+                        sums[name] = sums.get(name, 0) + float(np.mean(blob))
+            results.append(dict([(name, total / test_iter) for (name, total) in sums.items()]))
+            print "{} iter {}, test net {}: {}".format(self.workdir, self.solver.iter, k, ', '.join(['{} = {:.4f}'.format(name, value) for (name, value) in sorted(results[-1].items())]))
+        return results
+
+    def snapshot(self):
+        """
+        Writes a snapshot (caffemodel and solverstate), unless there is one of the current iteration already.
+        """
+        if self.solver.iter != self._snapshot_iter:
+            with self._selected():
+                self.solver.snapshot()
+            self._snapshot_iter = self.solver.iter
+
+    def close(self):
+        """
+        Snapshots and releases the solver.
+        """
+        self.snapshot()
+        self.solver = None
 
 
-def cycle_runs(run_params, test_params, cycle_sizes, ncycles, classify = True):
+def cycle_runs(run_params, test_params, cycle_sizes, ncycles, classify = True, keep_fraction = None, sessions = False, statefile = None):
     """
     cycle_runs is a wrapper around run and classify methods. It cycles through the various experiments, thus running them in "parrallell". After training net i for cycle_sizes[i] iterations, it will run through the TEST set of all *net.prototxt files in the directory and store these to disk. It will then move on to the next experiment, and cycle though all for ncycles.
 
@@ -290,7 +458,8 @@ def cycle_runs(run_params, test_params, cycle_sizes, ncycles, classify = True):
 
     test_params: is a list of dictionaries. List must be same length as run_params.
     Each directory is passed on to the "classify" method above. Each dictionary must contain values for the 
-    ['scorelayer'] parameter.
+    ['scorelayer'] parameter. If a dictionary has a ['pyparams'] entry, it is instead passed on to "classify_from_patchlist" (and must also contain ['imlist'] and ['imdict']).
+    The patches are then cached in ['cachedir'], which defaults to patch_cache next to the workdir.
 
     cycle_sizes: array of ints of the same length as run_params. 
     Cycle_sizes determines the nbr iterations for each experiment in run_params list.
@@ -298,29 +467,153 @@ def cycle_runs(run_params, test_params, cycle_sizes, ncycles, classify = True):
     ncycles: integer.
     Total number of cycles to complete.
 
+    keep_fraction: float in (0, 1) or None.
+    If given, the iterations are allocated by successive halving. After each cycle, the experiments are scored on the accuracy of their classify outputs, or on their last test loss in the train log if classify = False. Only the best keep_fraction (at least one) of the experiments continue to the next cycle, and the iterations of the dropped experiments are divided among them, in proportion to their cycle sizes.
+
+    sessions: bool.
+    If True, each experiment trains in a SolverSession that stays alive across the cycles, instead of a new caffe process per cycle. The ['workdir'], ['solverfile'], ['caffemodel'], ['GPU_id'], ['snapshot_prefix'], ['restart'] and ['cursorfile'] entries of run_params are used. 
+    Instead of classify, the solver's test nets are run in-process (the experiments are then scored on their 'accuracy' output, else on their 'loss'), and test_params is not used. Snapshots are written at the end of each cycle, and when an experiment is dropped or cycle_runs stops.
 
+    statefile: file to keep the successive halving state in (the current cycle, the active experiments, their budgets, the scores so far), so that a restarted cycle_runs continues where it stopped instead of bringing back the dropped experiments. Defaults to cycle_runs_state.json next to the first workdir. Only used with keep_fraction. The state is only resumed for the same workdirs, cycle_sizes and keep_fraction; remove the file to start over.
+
+    Gives
+    list with one dict per cycle, mapping the workdir of each experiment that ran in that cycle to its score (empty unless keep_fraction is given).
 
     """
-    run_defaults = {'solver':'solver.prototxt', 'GPU_id':0, 'log':'train.log','snapshot_prefix':'snapshot','caffepath':'/home/beijbom/cc/build/tools/caffe', 'restart': False}
+    run_defaults = {'solverfile':'solver.prototxt', 'GPU_id':0, 'log':'train.log','snapshot_prefix':'snapshot','caffepath':'/home/beijbom/cc/build/tools/caffe', 'restart': False}
     test_defaults = {'caffemodel':None, 'snapshot_prefix':'snapshot', 'GPU_id':0, 'save':True, 'ignore_label':255, 'n_testinstances':None}
-    for cycle in range(ncycles):
-        for (cycle_size, params, tparams) in zip(cycle_sizes, run_params, test_params):
+    state = {'workdirs': [params['workdir'] for params in run_params], 'cycle_sizes': [int(size) for size in cycle_sizes], 'keep_fraction': keep_fraction,
+        'cycle': 0, 'active': range(len(run_params)), 'budgets': [int(size) for size in cycle_sizes], 'history': [], 'scores': []}
+    if keep_fraction is not None:
+        if statefile is None:
+            statefile = os.path.join(os.path.dirname(os.path.abspath(run_params[0]['workdir'])), 'cycle_runs_state.json')
+        if os.path.isfile(statefile):
+            with open(statefile) as f:
+                saved = json.load(f)
+            if all([saved[key] == state[key] for key in ['workdirs', 'cycle_sizes', 'keep_fraction']]):
+                state = saved
+                print "cycle_runs resumes cycle {} with {} from {}.".format(state['cycle'], [state['workdirs'][i] for i in state['active']], statefile)
+            else:
+                print "Ignoring {}, it is for other experiments.".format(statefile)
+    else:
+        statefile = None
+    open_sessions = {}
+    try:
+        history = _cycle(run_params, test_params, ncycles, classify, keep_fraction, sessions, run_defaults, test_defaults, state, statefile, open_sessions)
+    finally:
+        # snapshot the sessions, also if we stop on an error or KeyboardInterrupt.
+        for session in open_sessions.values():
+            session.close()
+    return history
+
+
+def _save_cycle_state(statefile, state):
+    """
+    Writes the successive halving state of cycle_runs (atomically, so a crash never leaves a partial file).
+    """
+    with open(statefile + '.tmp', 'w') as f:
+        json.dump(state, f)
+    os.rename(statefile + '.tmp', statefile)
+
+
+def _cycle(run_params, test_params, ncycles, classify, keep_fraction, sessions, run_defaults, test_defaults, state, statefile, open_sessions):
+    """
+    The cycles of cycle_runs. Updates state (see cycle_runs), and saves it to statefile (if given) after each experiment.
+    """
+    (active, budgets, history) = (state['active'], state['budgets'], state['history'])
+    for cycle in range(state['cycle'], ncycles):
+        scores = dict([(i, score) for (i, score) in state['scores']]) # of the experiments that already ran in this cycle.
+        for i in active:
+            if i in scores:
+                continue
+            (cycle_size, params, tparams) = (budgets[i], run_params[i], test_params[i])
             # add defaults to run_parameter dict
             for key in list(set(run_defaults) - set(params)):
                 params[key] = run_defaults[key]
             params['nbr_iters'] = cycle_size
-            run(**params)        
+            predictions = []
+            if sessions:
+                if i not in open_sessions:
+                    open_sessions[i] = SolverSession(**dict([(key, params.get(key)) for key in ['workdir', 'solverfile', 'caffemodel', 'GPU_id', 'snapshot_prefix', 'restart', 'cursorfile'] if key in params]))
+                with trace.span('cycle_runs.run', workdir = params['workdir'], cycle = cycle):
+                    open_sessions[i].step(cycle_size)
+                    open_sessions[i].snapshot()
+                if classify or keep_fraction is not None:
+                    # a session has no train log to score on, so its test nets always run when halving.
+                    predictions = open_sessions[i].test()
+            else:
+                with trace.span('cycle_runs.run', workdir = params['workdir'], cycle = cycle):
+                    run(**params)        
 
-            if classify:
+            if classify and not sessions:
                 # classify all *net.prototxt in workdir
                 testnets = glob.glob(os.path.join(params['workdir'], '*net.prototxt'))
                 for testnet in testnets:
                     # add params to tparams dict
                     tparams['workdir'] = params['workdir'] #assuming the same workdir
                     tparams['net_prototxt'] = testnet
-                    for key in list(set(test_defaults) - set(tparams)):
-                        tparams[key] = test_defaults[key]
-                    classify(**tparams)
+                    with trace.span('cycle_runs.classify', workdir = params['workdir'], cycle = cycle, net_prototxt = testnet):
+                        if 'pyparams' in tparams:
+                            # point patch test sets are classified from the patch cache, which is shared by all experiments and cycles.
+                            for key in ['snapshot_prefix', 'GPU_id', 'save']:
+                                tparams.setdefault(key, test_defaults[key])
+                            tparams.setdefault('cachedir', os.path.abspath(os.path.join(params['workdir'], os.pardir, 'patch_cache')))
+                            predictions.append(classify_from_patchlist(**tparams))
+                        else:
+                            for key in list(set(test_defaults) - set(tparams)):
+                                tparams[key] = test_defaults[key]
+                            predictions.append(_classify(**tparams))
+
+            if keep_fraction is not None:
+                if predictions:
+                    scores[i] = np.mean([_prediction_accuracy(prediction) for prediction in predictions])
+                else:
+                    scores[i] = -parse_test_loss(os.path.join(params['workdir'], params['log']))
+                if statefile is not None:
+                    state['scores'] = sorted(scores.items())
+                    _save_cycle_state(statefile, state)
+
+        if keep_fraction is not None and len(active) > 1:
+            ranked = sorted(active, key = lambda i: scores[i], reverse = True)
+            nkeep = max(1, int(round(len(active) * keep_fraction)))
+            (kept, dropped) = (ranked[:nkeep], ranked[nkeep:])
+            freed = sum([budgets[i] for i in dropped])
+            kept_total = float(sum([budgets[i] for i in kept]))
+            for i in kept:
+                budgets[i] += int(round(freed * budgets[i] / kept_total))
+            active = sorted(kept)
+            for i in dropped:
+                if i in open_sessions:
+                    open_sessions.pop(i).close()
+            print "Cycle {}: keeping {}, dropping {}.".format(cycle, [run_params[i]['workdir'] for i in kept], [run_params[i]['workdir'] for i in dropped])
+        history.append(dict([(run_params[i]['workdir'], score) for (i, score) in scores.items()]))
+        state.update({'cycle': cycle + 1, 'active': active, 'scores': []})
+        if statefile is not None:
+            _save_cycle_state(statefile, state)
+    return history
+
+
+def _prediction_accuracy(prediction):
+    """
+    Returns the accuracy of a classify or classify_from_patchlist output, or of the test net outputs of a SolverSession.
+    """
+    if isinstance(prediction, dict):
+        return prediction['accuracy'] if 'accuracy' in prediction else -prediction.get('loss', np.inf)
+    if isinstance(prediction[0], confmatrix.ConfMatrix):
+        return prediction[0].get_accuracy()[0]
+    (gt, est) = prediction[:2]
+    return np.mean(np.asarray(gt) == np.asarray(est))
+
+
+def parse_test_loss(logfile):
+    """
+    Returns the last test loss reported in caffe logfile, or inf if there is none.
+    """
+    losses = []
+    if os.path.isfile(logfile):
+        with open(logfile) as f:
+            losses = re.findall('Test net output #[0-9]+: loss = ([-0-9.eE+]+)', f.read())
+    return float(losses[-1]) if losses else np.inf
 
 
 
@@ -343,13 +636,19 @@ def cycle_runs_debug(run_params, test_params, classify=True):
             os.remove(file_)
         os.remove(os.path.join(run_param['workdir'], 'train.log'))
 
-def load_model(workdir, caffemodel, GPU_id = 0, net_prototxt = 'net.prototxt', phase = caffe.TEST):
+def load_model(workdir, caffemodel, GPU_id = 0, net_prototxt = 'net.prototxt', phase = None):
     """
     changes current directory to INPUT workdir and loads INPUT net_prototxt.
+    phase defaults to caffe.TEST. GPU_id = None runs the net in CPU mode.
     """
+    if phase is None:
+        phase = caffe.TEST
     os.chdir(workdir)
-    caffe.set_device(GPU_id)
-    caffe.set_mode_gpu()
+    if GPU_id is None:
+        caffe.set_mode_cpu()
+    else:
+        caffe.set_device(GPU_id)
+        caffe.set_mode_gpu()
     net = caffe.Net(net_prototxt, caffemodel, phase)
     net.forward() #one forward to initialize the net
     return net
@@ -365,9 +664,67 @@ def nbr_lines(fname):
     return i + 1
 
 
+def profile_net(net, niter = 10, backward = True, jsonfile = None):
+    """
+    profile_net times the forward (and backward) pass of each layer of a loaded net, e.g. from load_model.
 
+    Takes
+    net: caffe net object.
+    niter: number of full forward (and backward) passes to time.
+    backward: whether to also time the backward pass. Layers without bottoms (e.g. the python data layers) are skipped.
+    jsonfile: if given, the results are also written to this file as json.
 
+    Gives
+    list of dicts, one per layer and pass, sorted by mean time. Each dict has keys 'name', 'type', 'pass', 'mean', 'p95' (seconds) and 'share' (of the total time). The forward of the python data layers includes the time spent waiting for the batch advancer thread.
 
+    NOTE: In GPU mode kernels run asynchronously, so time may be attributed to the next layer that synchronizes. Profile in CPU mode for exact attribution.
+    """
+    # We step one layer at a time using the _forward / _backward bindings. net.forward(start, end) would do the same, but looks up "end" as a blob name, which fails for in-place layers.
+    layer_names = list(net._layer_names)
+    nlayers = len(layer_names)
+    passes = ['forward', 'backward'] if backward else ['forward']
+    times = dict([(p, np.zeros((niter, nlayers))) for p in passes])
+    has_bottoms = [len(net.bottom_names[name]) > 0 for name in layer_names]
+
+    for itt in range(niter):
+        for i in range(nlayers):
+            t0 = timer()
+            net._forward(i, i)
+            times['forward'][itt, i] = timer() - t0
+        if backward:
+            for i in reversed(range(nlayers)):
+                if not has_bottoms[i]:
+                    continue
+                t0 = timer()
+                net._backward(i, i)
+                times['backward'][itt, i] = timer() - t0
+
+    total = sum([np.sum(np.mean(times[p], axis = 0)) for p in passes])
+    results = []
+    for p in passes:
+        for i, name in enumerate(layer_names):
+            if p == 'backward' and not has_bottoms[i]:
+                continue
+            mean = float(np.mean(times[p][:, i]))
+            results.append({'name': name, 'type': net.layers[i].type, 'pass': p, 'mean': mean, 'p95': float(np.percentile(times[p][:, i], 95)), 'share': mean / total})
+    results.sort(key = lambda r: r['mean'], reverse = True)
+
+    print "{:<20} {:<16} {:<9} {:>10} {:>10} {:>7}".format('layer', 'type', 'pass', 'mean (ms)', 'p95 (ms)', 'share')
+    for r in results:
+        print "{:<20} {:<16} {:<9} {:>10.2f} {:>10.2f} {:>6.1f}%".format(r['name'], r['type'], r['pass'], 1000 * r['mean'], 1000 * r['p95'], 100 * r['share'])
+    data_share = sum([r['share'] for r in results if r['type'] == 'Python'])
+    print "Total: {:.1f} ms per iteration, of which {:.1f}% in python data layers.".format(1000 * total, 100 * data_share)
+
+    if jsonfile is not None:
+        with open(jsonfile, 'w') as f:
+            json.dump(results, f, indent = 2)
+    return results
+
+
+
+
+
+@trace.traced('sac')
 def sac(im, net, transformer, scorelayer, target_size = [1024, 1024], padcolor = [126, 148, 137], startlayer = 'conv1_1'):
     """
     sac (slice and classify) slices the input image, feed each piece to the
@@ -393,9 +750,10 @@ def sac(im, net, transformer, scorelayer, target_size = [1024, 1024], padcolor =
     for row in range(ncells[0]):
         for col in range(ncells[1]):
             imcounter += 1
-            net.blobs['data'].data[...] = transformer.preprocess(imlist[imcounter])
-            net.forward(start = startlayer)
-            scores_slice = np.float32(np.squeeze(net.blobs[scorelayer].data.transpose(2, 3, 1, 0)))
+            with trace.span('sac.tile', row = row, col = col):
+                net.blobs['data'].data[...] = transformer.preprocess(imlist[imcounter])
+                net.forward(start = startlayer)
+                scores_slice = np.float32(np.squeeze(net.blobs[scorelayer].data.transpose(2, 3, 1, 0)))
             if col == 0:
                 scores_row = deepcopy(scores_slice)
             else:
@@ -429,8 +787,10 @@ def classify_imlist(im_list, net, transformer, batch_size, scorelayer, startlaye
             pos += 1
             if pos < len(im_list):
                 net.blobs['data'].data[i, :, :, :] = transformer.preprocess(im_list[pos])
-        net.forward(start = startlayer)
+        with trace.span('classify_imlist.forward', batch = b):
+            net.forward(start = startlayer)
         scorelist.extend(list(copy(net.blobs[scorelayer].data).astype(np.float)))
+    trace.counter('classify_imlist.images', len(im_list))
         
     scorelist = scorelist[:len(im_list)]
     estlist = [np.argmax(s) for s in scorelist]  
@@ -438,44 +798,428 @@ def classify_imlist(im_list, net, transformer, batch_size, scorelayer, startlaye
     return(estlist, scorelist)
 
 
-def classify_from_patchlist(imlist, imdict, pyparams, workdir, scorelayer = 'score', startlayer = 'conv1_1', net_prototxt = 'testnet.prototxt', GPU_id = 0, snapshot_prefix = 'snapshot', save = False):
+def _load_padded_image(imname, imdict, pyparams):
+    """
+    Loads, rescales and pads INPUT image. Returns (im, centers, gtlist), where centers holds the (row, col) of the annotated points in the padded image.
+    """
+    (point_anns, height_cm) = imdict[os.path.basename(imname)]
+
+    # Load image (imname can be a local path or url, see beijbom_image_source)
+    im = np.asarray(get_source(pyparams).open(imname))
+    (im, scale) = coral_image_resize(im, pyparams['scaling_method'], pyparams['scaling_factor'], height_cm) #resize.
+
+    # Pad the boundaries                        
+    im = np.pad(im, ((pyparams['crop_size']*2, pyparams['crop_size']*2),(pyparams['crop_size']*2, pyparams['crop_size']*2), (0, 0)), mode='reflect')        
+    
+    centers = [np.round(pyparams['crop_size']*2 + np.asarray([row, col]) * scale).astype(np.int) for (row, col, label) in point_anns]
+    gtlist = [label for (row, col, label) in point_anns]
+    return (im, centers, gtlist)
+
+
+def _image_patches(imname, imdict, pyparams, variants = [(0, False)]):
+    """
+    Loads, rescales and pads INPUT image, and returns (patchlist, gtlist) for the annotated points in imdict.
+    patchlist holds one patch per (angle, flip) in variants for each point, with the variants of a point next to each other.
+    """
+    (im, centers, gtlist) = _load_padded_image(imname, imdict, pyparams)
+    patchlist = [patch for center in centers for patch in crop_variants(im, center, pyparams['crop_size'], variants)]
+    return (patchlist, gtlist)
+
+
+def _reduce_variants(scorelist, nvariants, reduce = 'mean'):
+    """
+    Reduces the scores of the nvariants consecutive (test-time augmentation) variants of each point in scorelist to one score vector per point, by their 'mean' or 'max'.
+    """
+    if nvariants == 1 or len(scorelist) == 0:
+        return scorelist
+    scores = np.asarray(scorelist).reshape(len(scorelist) // nvariants, nvariants, -1)
+    return list(scores.mean(axis = 1) if reduce == 'mean' else scores.max(axis = 1))
+
+
+def fc_to_conv(workdir, caffemodel, net_prototxt = 'testnet.prototxt', crop_size = 224, kernel_sizes = {'fc6': 7, 'fc7': 1, 'score': 1}):
+    """
+    fc_to_conv converts the fully connected layers of a trained vgg net to equivalent convolutions, so that the net can be run on a full image.
+
+    Takes
+    workdir: directory where net_prototxt and caffemodel live.
+    caffemodel: name of the trained caffemodel.
+    net_prototxt: the (test) net to convert. The python data layer is replaced by an input blob called 'data', and the layers that use the labels are removed.
+    crop_size: patch size the net was trained on. Sets the initial input shape.
+    kernel_sizes: dict of InnerProduct layer name: kernel size of the equivalent convolution. fc6 sees the 7x7 pool5 output of a 224 patch.
+
+    Gives
+    (fcn_prototxt, fcn_caffemodel): names of the converted net ({name}_fcn.prototxt) and weights (fcn_{caffemodel}) in workdir. The conv layers are named e.g. 'fc6-conv', but keep their tops, so the score blob has the same name. The files are reused if they are newer than caffemodel.
+    """
+    from caffe.proto import caffe_pb2
+
+    # NOTE: the converted prototxt must not end with net.prototxt, or cycle_runs would evaluate it as a test net.
+    name = os.path.splitext(os.path.basename(net_prototxt))[0]
+    (fcn_prototxt, fcn_caffemodel) = (name + '_fcn.prototxt', 'fcn_' + caffemodel)
+    if os.path.isfile(os.path.join(workdir, fcn_caffemodel)) and os.path.getmtime(os.path.join(workdir, fcn_caffemodel)) >= os.path.getmtime(os.path.join(workdir, caffemodel)):
+        return (fcn_prototxt, fcn_caffemodel)
+
+    proto = read_net_proto(os.path.join(workdir, net_prototxt))
+    deploy = {}
+    for convert in [False, True]:
+        deploy[convert] = caffe_pb2.NetParameter(name = proto.name)
+        data = deploy[convert].layer.add(name = 'data', type = 'Input', top = ['data'])
+        data.input_param.shape.add(dim = [1, 3, crop_size, crop_size])
+        for layer in proto.layer:
+            if layer.type == 'Python' or 'label' in layer.bottom:
+                continue
+            newlayer = deploy[convert].layer.add()
+            newlayer.CopyFrom(layer)
+            if convert and layer.name in kernel_sizes:
+                newlayer.name = layer.name + '-conv'
+                newlayer.type = 'Convolution'
+                newlayer.ClearField('inner_product_param')
+                newlayer.convolution_param.num_output = layer.inner_product_param.num_output
+                newlayer.convolution_param.kernel_size.append(kernel_sizes[layer.name])
+
+    # Load both with the trained weights (the renamed conv layers get none), and copy the fc weights over.
+    nets = {}
+    for convert in [False, True]:
+        prototxt = os.path.join(workdir, fcn_prototxt if convert else name + '_fc.prototxt')
+        with open(prototxt, 'w') as f:
+            f.write(str(deploy[convert]))
+        nets[convert] = caffe.Net(prototxt, os.path.join(workdir, caffemodel), caffe.TEST)
+    os.remove(os.path.join(workdir, name + '_fc.prototxt'))
+    for name in kernel_sizes:
+        for i in range(len(nets[False].params[name])):
+            nets[True].params[name + '-conv'][i].data.flat = nets[False].params[name][i].data.flat
+    nets[True].save(os.path.join(workdir, fcn_caffemodel))
+    return (fcn_prototxt, fcn_caffemodel)
+
+
+def _call_in_child(func, *args, **kwargs):
+    """
+    Returns func(*args, **kwargs), computed in a short-lived child process, so that this process does not initialize caffe. CUDA contexts do not survive a fork, so the parent of a worker pool must not touch caffe.
+    """
+    pool = multiprocessing.Pool(1)
+    try:
+        return pool.apply(func, args, kwargs)
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def dense_point_scores(im, centers, net, transformer, scorelayer = 'score', tile_size = 1024, crop_size = 224, stride = 32):
+    """
+    dense_point_scores runs a fully convolutional net (from fc_to_conv) over im, and returns the scores of the crop_size window centered (to the nearest stride) on each point.
+
+    Takes
+    im: (padded) input image, as from _load_padded_image.
+    centers: list of (row, col) point locations in im. Points should be at least crop_size / 2 from the edges.
+    net: fully convolutional caffe net object.
+    transformer: transformer object as defined above.
+    tile_size: size of the tiles fed to the net. Must be crop_size + k * stride.
+    stride: total stride of the net (32 for vgg).
+
+    Gives
+    scorelist: list of score vectors, one per point.
+
+    Like sac, the image is fed to the net in tiles. Output cell j of a tile covers the window starting at pixel j * stride, so the tiles overlap by crop_size - stride pixels to cover every window exactly once. Tiles without any points are skipped.
+    """
+    assert (tile_size - crop_size) % stride == 0, "tile_size must be crop_size plus a multiple of stride"
+    centers = np.asarray(centers, dtype = np.int).reshape(-1, 2)
+    nwindows = [(s - crop_size) // stride + 1 for s in im.shape[:2]]
+    windows = np.clip(np.round((centers - crop_size / 2) / float(stride)).astype(np.int), 0, np.asarray(nwindows) - 1)
+    tile_windows = (tile_size - crop_size) // stride + 1
+    scores = [None] * len(centers)
+    for wrow in range(0, nwindows[0], tile_windows):
+        for wcol in range(0, nwindows[1], tile_windows):
+            inside = np.flatnonzero((windows[:, 0] >= wrow) & (windows[:, 0] < wrow + tile_windows) & (windows[:, 1] >= wcol) & (windows[:, 1] < wcol + tile_windows))
+            if len(inside) == 0:
+                continue
+            with trace.span('dense_point_scores.tile', row = wrow, col = wcol):
+                # crop the tile so that it holds a whole number of windows.
+                shape = [crop_size + (min(tile_windows, n - w) - 1) * stride for (n, w) in zip(nwindows, [wrow, wcol])]
+                tile = im[wrow * stride : wrow * stride + shape[0], wcol * stride : wcol * stride + shape[1]]
+                net.blobs['data'].reshape(1, 3, shape[0], shape[1])
+                net.reshape()
+                net.blobs['data'].data[0] = transformer.preprocess(tile)
+                net.forward()
+                for i in inside:
+                    scores[i] = np.copy(net.blobs[scorelayer].data[0, :, windows[i, 0] - wrow, windows[i, 1] - wcol]).astype(np.float)
+    return scores
+
+
+def patch_cache(imlist, imdict, pyparams, cachedir, variants = [(0, False)]):
+    """
+    patch_cache extracts the preprocessed evaluation patches of imlist once, and stores them in cachedir, so that repeated evaluations of the same test set only cost the forward passes.
+
+    Takes
+    imlist, imdict, pyparams: as for classify_from_patchlist.
+    cachedir: directory for the cache. Each entry is a subdirectory named by a hash of imlist, the imdict entries of imlist, the scaling parameters, crop_size, im_mean and variants, so an entry is never reused if any of them change.
+    variants: list of (angle, flip) patch variants per point, see crop_variants.
+
+    Gives
+    (patches, gtlist, offsets): patches is a read-only memmap of shape (npoints * len(variants), 3, crop_size, crop_size) with the preprocessed float32 patches, in the order of imlist, with the variants of each point next to each other. The points of image i are offsets[i] to offsets[i + 1].
+    """
+    keylist = [list(imlist), [imdict[os.path.basename(imname)] for imname in imlist], pyparams['scaling_method'], pyparams['scaling_factor'],
+        pyparams['crop_size'], [float(m) for m in pyparams['im_mean']]]
+    if list(variants) != [(0, False)]:
+        keylist.append([[angle, bool(flip)] for (angle, flip) in variants]) # so that the existing angle 0 entries stay valid.
+    key = json.dumps(keylist, sort_keys = True)
+    entry = os.path.join(cachedir, hashlib.sha1(key).hexdigest())
+    if not os.path.isdir(entry):
+        # Build the entry in a temporary directory and rename it when done, so that a crash never leaves a partial entry.
+        tmpentry = '{}.tmp{}'.format(entry, os.getpid())
+        if os.path.isdir(tmpentry):
+            shutil.rmtree(tmpentry)
+        os.makedirs(tmpentry)
+        counts = [len(imdict[os.path.basename(imname)][0]) for imname in imlist]
+        transformer = Transformer(pyparams['im_mean'])
+        patches = np.lib.format.open_memmap(os.path.join(tmpentry, 'patches.npy'), mode = 'w+', dtype = np.float32, shape = (sum(counts) * len(variants), 3, pyparams['crop_size'], pyparams['crop_size']))
+        gtlist = []
+        print "caching {} patches from {} images in {}".format(sum(counts), len(imlist), entry)
+        for imcounter, imname in enumerate(tqdm(imlist)):
+            get_source(pyparams).prefetch(imlist[imcounter : imcounter + pyparams.get('readahead', 16)])
+            (patchlist, this_gtlist) = _image_patches(imname, imdict, pyparams, variants)
+            for i, patch in enumerate(patchlist):
+                patches[len(gtlist) * len(variants) + i] = transformer.preprocess(patch)
+            gtlist.extend(this_gtlist)
+        patches.flush()
+        del patches
+        np.save(os.path.join(tmpentry, 'gt.npy'), np.asarray(gtlist))
+        np.save(os.path.join(tmpentry, 'offsets.npy'), np.cumsum([0] + counts))
+        os.rename(tmpentry, entry)
+    return (np.load(os.path.join(entry, 'patches.npy'), mmap_mode = 'r'), list(np.load(os.path.join(entry, 'gt.npy'))), np.load(os.path.join(entry, 'offsets.npy')))
+
+
+# Per-process state of the classify_from_patchlist workers. Set by _init_patchlist_worker.
+_patchlist_worker = {}
+
+def _init_patchlist_worker(devices, threads, imdict, pyparams, workdir, caffemodel, net_prototxt, scorelayer, startlayer, tile_size = None, cache = None, variants = [(0, False)], tta_reduce = 'mean'):
+    """
+    Pool initializer for classify_from_patchlist. Takes a device from the devices queue and loads the net once for this worker.
+    """
+    if threads is not None:
+        for var in ['OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS']:
+            os.environ[var] = str(threads)
+    _patchlist_worker.update({'net': load_model(workdir, caffemodel, GPU_id = devices.get(), net_prototxt = net_prototxt),
+        'transformer': Transformer(pyparams['im_mean']), 'imdict': imdict, 'pyparams': pyparams, 'scorelayer': scorelayer, 'startlayer': startlayer, 'tile_size': tile_size, 'cache': cache,
+        'variants': variants, 'tta_reduce': tta_reduce})
+
+
+def _classify_image_worker(imname):
+    """
+    Classifies the points of INPUT image using the net of this worker. Returns (gtlist, estlist, scorelist).
+    """
+    w = _patchlist_worker
+    if w['tile_size'] is not None:
+        with trace.span('classify_from_patchlist.image', imname = imname):
+            (im, centers, gtlist) = _load_padded_image(imname, w['imdict'], w['pyparams'])
+            scorelist = dense_point_scores(im, centers, w['net'], w['transformer'], scorelayer = w['scorelayer'], tile_size = w['tile_size'], crop_size = w['pyparams']['crop_size'])
+        trace.flush()
+        return (gtlist, [np.argmax(s) for s in scorelist], scorelist)
+    with trace.span('classify_from_patchlist.image', imname = imname):
+        with trace.span('classify_from_patchlist.patches'):
+            (patchlist, gtlist) = _image_patches(imname, w['imdict'], w['pyparams'], w['variants'])
+        # the variants of all points share the forward batches.
+        (_, scorelist) = classify_imlist(patchlist, w['net'], w['transformer'], w['pyparams']['batch_size'], scorelayer = w['scorelayer'], startlayer = w['startlayer'])
+        scorelist = _reduce_variants(scorelist, len(w['variants']), w['tta_reduce'])
+    trace.flush() # so that the events of pool workers end up in the tracedir.
+    return (gtlist, [np.argmax(s) for s in scorelist], scorelist)
+
+
+def _classify_rows_worker(rows):
+    """
+    Classifies points (start, stop) of the patch cache of this worker. Returns (gtlist, estlist, scorelist).
+    """
+    w = _patchlist_worker
+    (patches, gtlist, offsets) = w['cache']
+    (net, batch_size, nvariants) = (w['net'], w['pyparams']['batch_size'], len(w['variants']))
+    scorelist = []
+    for b in range(rows[0] * nvariants, rows[1] * nvariants, batch_size):
+        batch = patches[b : min(b + batch_size, rows[1] * nvariants)]
+        net.blobs['data'].data[:len(batch)] = batch
+        with trace.span('classify_from_patchlist.forward'):
+            net.forward(start = w['startlayer'])
+        scorelist.extend(list(copy(net.blobs[w['scorelayer']].data[:len(batch)]).astype(np.float)))
+    scorelist = _reduce_variants(scorelist, nvariants, w['tta_reduce'])
+    trace.flush()
+    return (gtlist[rows[0] : rows[1]], [np.argmax(s) for s in scorelist], scorelist)
+
+
+@trace.traced('classify_from_patchlist')
+def classify_from_patchlist(imlist, imdict, pyparams, workdir, scorelayer = 'score', startlayer = 'conv1_1', net_prototxt = 'testnet.prototxt', GPU_id = 0, snapshot_prefix = 'snapshot', save = False, nworkers = 1, threads_per_worker = None, dense = False, tile_size = 1024, cachedir = None, caffemodel = None, tta = None, tta_reduce = 'mean'):
+    """
+    classify_from_patchlist classifies the annotated points in imlist, one patch per point, using caffemodel, or if not given, the latest snapshot in workdir.
+
+    Takes
+    imlist: list of image file names.
+    imdict: dict of image basename: (point_anns, height_cm), where point_anns is a list of (row, col, label).
+    pyparams: data layer parameters (im_mean, scaling_method, scaling_factor, crop_size, batch_size). May also hold the image source settings (see beijbom_image_source.get_source) and 'readahead', the number of (remote) images to fetch ahead.
+    GPU_id: device to run on, None for CPU mode. With nworkers > 1, this can be a list of devices, which are assigned to the workers in turn.
+    nworkers: number of worker processes. The images are split across the workers, and each worker loads the net once.
+    threads_per_worker: if given, the number of BLAS / OpenMP threads of each worker process. Only used with nworkers > 1.
+    dense: if True, the fully connected layers are converted to convolutions (see fc_to_conv), and each rescaled image is run through the net once, in tiles of tile_size (see dense_point_scores). Each point gets the scores of the output cell nearest to it, i.e. its patch is shifted by up to 16 pixels. Use check_dense_classification to compare to the patch based results.
+    cachedir: if given (and not dense), the preprocessed patches are read from (or first written to) a cache in cachedir, see patch_cache. Repeated evaluations of the same test set then only cost the forward passes.
+    tta: list of (angle, flip) test-time augmentation variants, e.g. [(0, False), (90, False), (0, True)]. Each image is decoded once and all variants of its points (rotated by angle degrees, and mirrored left-right if flip) share the forward batches. Not supported with dense.
+    tta_reduce: 'mean' or 'max'. How the scores of the variants of each point are combined.
+
+    Gives
+    [gtlist, estlist, scorelist], one entry per point, in the order of imlist (regardless of nworkers).
+    """
 
     # Preliminaries    
-    caffemodel = find_latest_caffemodel(workdir, snapshot_prefix = snapshot_prefix)
-    net = load_model(workdir, caffemodel, GPU_id = GPU_id, net_prototxt = net_prototxt)
-    transformer = Transformer(pyparams['im_mean'])
+    if caffemodel is None:
+        caffemodel = find_latest_caffemodel(workdir, snapshot_prefix = snapshot_prefix)
     estlist, scorelist, gtlist = [], [], []
+    devices = GPU_id if isinstance(GPU_id, (list, tuple)) else [GPU_id]
+    assert not (dense and tta), "tta is not supported with dense classification"
+    assert tta_reduce in ['mean', 'max'], "tta_reduce must be 'mean' or 'max'"
+    variants = [(angle, bool(flip)) for (angle, flip) in tta] if tta else [(0, False)]
+    (model_prototxt, model_caffemodel, model_tile_size, cache) = (net_prototxt, caffemodel, None, None)
+    if dense:
+        # the conversion loads the net, so keep it out of this process, which forks the workers.
+        (model_prototxt, model_caffemodel) = _call_in_child(fc_to_conv, workdir, caffemodel, net_prototxt = net_prototxt, crop_size = pyparams['crop_size'])
+        model_tile_size = tile_size
+    elif cachedir is not None:
+        cache = patch_cache(imlist, imdict, pyparams, cachedir, variants)
+    
+    # Without the cache, each task is an image. With the cache, each task is a range of cached points, a few batches long.
+    if cache is None:
+        (worker, tasks) = (_classify_image_worker, imlist)
+        readahead = pyparams.get('readahead', 16) + nworkers
+        get_source(pyparams).prefetch(imlist[:readahead])
+    else:
+        npoints = len(cache[1])
+        task_rows = max(1, 8 * pyparams['batch_size'] // len(variants))
+        (worker, tasks) = (_classify_rows_worker, [(start, min(start + task_rows, npoints)) for start in range(0, npoints, task_rows)])
     
     print "classifying {} images in {} using {}".format(len(imlist), workdir, caffemodel)
-    for imname in tqdm(imlist):
-        
-        patchlist = []
-        (point_anns, height_cm) = imdict[os.path.basename(imname)]
-
-        # Load image
-        im = np.asarray(Image.open(imname))
-        (im, scale) = coral_image_resize(im, pyparams['scaling_method'], pyparams['scaling_factor'], height_cm) #resize.
-
-        # Pad the boundaries                        
-        im = np.pad(im, ((pyparams['crop_size']*2, pyparams['crop_size']*2),(pyparams['crop_size']*2, pyparams['crop_size']*2), (0, 0)), mode='reflect')        
-        
-        # Extract patches
-        for (row, col, label) in point_anns:
-            center_org = np.asarray([row, col])
-            center = np.round(pyparams['crop_size']*2 + center_org * scale).astype(np.int)
-            patchlist.append(crop_and_rotate(im, center, pyparams['crop_size'], 0, tile = False))
-            gtlist.append(label)
-
-        # Classify and append
-        [this_estlist, this_scorelist] = classify_imlist(patchlist, net, transformer, pyparams['batch_size'], scorelayer = scorelayer, startlayer = startlayer)
-        estlist.extend(this_estlist)
-        scorelist.extend(this_scorelist)
+    (device_queue, pool) = (multiprocessing.Queue(), None)
+    try:
+        if nworkers > 1:
+            for i in range(nworkers):
+                device_queue.put(devices[i % len(devices)])
+            pool = multiprocessing.Pool(nworkers, initializer = _init_patchlist_worker, initargs = (device_queue, threads_per_worker, imdict, pyparams, workdir, model_caffemodel, model_prototxt, scorelayer, startlayer, model_tile_size, cache, variants, tta_reduce))
+            results = pool.imap(worker, tasks) # imap keeps the order of imlist.
+        else:
+            # threads_per_worker is not applied here, since it would stay set in this process.
+            device_queue.put(devices[0])
+            _init_patchlist_worker(device_queue, None, imdict, pyparams, workdir, model_caffemodel, model_prototxt, scorelayer, startlayer, model_tile_size, cache, variants, tta_reduce)
+            results = (worker(task) for task in tasks)
+
+        for taskcounter, (this_gtlist, this_estlist, this_scorelist) in enumerate(tqdm(results, total = len(tasks))):
+            if cache is None:
+                # fetch remote images ahead of the workers.
+                get_source(pyparams).prefetch(imlist[taskcounter : taskcounter + readahead])
+            gtlist.extend(this_gtlist)
+            estlist.extend(this_estlist)
+            scorelist.extend(this_scorelist)
+        if nworkers > 1:
+            pool.close()
+            pool.join()
+    finally:
+        if pool is not None:
+            pool.terminate()
+        # release the net of the in-process path, so that it does not hold the device after we return (e.g. while cycle_runs trains the next experiment).
+        _patchlist_worker.clear()
         
     if (save):
-        pickle.dump((gtlist, estlist, scorelist), open(os.path.join(workdir, 'predictions_using_' + caffemodel +  '.p'), 'wb'))
+        bmt.psave((gtlist, estlist, scorelist), os.path.join(workdir, ('predictions_dense_using_' if dense else 'predictions_tta_using_' if tta else 'predictions_using_') + caffemodel +  '.p'))
     return [gtlist, estlist, scorelist]
 
 
+def check_dense_classification(imlist, imdict, pyparams, workdir, nimages = 5, **kwargs):
+    """
+    Compares dense (fully convolutional) to patch based classification on the first nimages of imlist. Other keyword arguments go to classify_from_patchlist.
+    The results are not identical: the dense windows are shifted by up to stride / 2 pixels, and see image content where the patches see zero padding.
+
+    Gives
+    dict with the label 'agreement' (fraction of points with the same estimate), the accuracy of both methods, and the mean and max absolute score difference.
+    """
+    (gt, est_patch, scores_patch) = classify_from_patchlist(imlist[:nimages], imdict, pyparams, workdir, **kwargs)
+    (_, est_dense, scores_dense) = classify_from_patchlist(imlist[:nimages], imdict, pyparams, workdir, dense = True, **kwargs)
+    diff = np.abs(np.asarray(scores_patch) - np.asarray(scores_dense))
+    result = {'agreement': np.mean(np.asarray(est_patch) == np.asarray(est_dense)),
+        'accuracy_patch': np.mean(np.asarray(gt) == np.asarray(est_patch)), 'accuracy_dense': np.mean(np.asarray(gt) == np.asarray(est_dense)),
+        'mean_score_diff': np.mean(diff), 'max_score_diff': np.max(diff)}
+    print "dense vs. patch: {:.1%} agreement, accuracy {:.1%} vs. {:.1%}, score difference mean {:.3g} max {:.3g}".format(result['agreement'],
+        result['accuracy_dense'], result['accuracy_patch'], result['mean_score_diff'], result['max_score_diff'])
+    return result
+
+
+@trace.traced('extract_features')
+def extract_features(imlist, imdict, pyparams, workdir, outdir, blobs = ['fc7'], startlayer = 'conv1_1', net_prototxt = 'testnet.prototxt', GPU_id = 0, snapshot_prefix = 'snapshot', float16 = False):
+    """
+    extract_features runs the point patches of imlist through the latest snapshot in workdir (as classify_from_patchlist), and writes the activations of the given blobs to .npy memory maps.
+    Extraction is resumable: a progress file is updated after each image, and calling again with the same outdir continues from the first unfinished image.
+
+    Takes
+    imlist, imdict, pyparams: as for classify_from_patchlist.
+    outdir: directory for the output. Gets one {blob}.npy per blob, index.npy, imlist.txt and progress.json.
+    blobs: list of blob names to extract, e.g. ['fc6', 'fc7'].
+    float16: whether to store the features as float16 (default float32).
+
+    Gives
+    (features, index): features is a dict of blob name: read-only memmap of shape (npoints, ...). index is an (npoints, 3) int array, where row i holds (image index in imlist, point index in the image, label) of feature row i.
+    """
+    if not os.path.isdir(outdir):
+        os.makedirs(outdir)
+    dtype = np.float16 if float16 else np.float32
+    progressfile = os.path.join(outdir, 'progress.json')
+
+    # Build the index. Row i of each feature array belongs to point index[i, 1] of image index[i, 0].
+    index = []
+    for imcounter, imname in enumerate(imlist):
+        (point_anns, height_cm) = imdict[os.path.basename(imname)]
+        index.extend([(imcounter, pointcounter, label) for pointcounter, (row, col, label) in enumerate(point_anns)])
+    index = np.array(index, dtype = np.int64).reshape(-1, 3)
+    image_offsets = np.searchsorted(index[:, 0], np.arange(len(imlist) + 1))
+
+    caffemodel = find_latest_caffemodel(workdir, snapshot_prefix = snapshot_prefix)
+    net = load_model(workdir, caffemodel, GPU_id = GPU_id, net_prototxt = net_prototxt)
+    transformer = Transformer(pyparams['im_mean'])
+    batch_size = net.blobs['data'].data.shape[0]
+
+    # Resume if the progress file matches this extraction, else start over.
+    # The patches depend on the annotations and the patch parameters, so they are part of the settings (as a hash, like the patch_cache key).
+    patch_key = json.dumps([[imdict[os.path.basename(imname)] for imname in imlist], pyparams['scaling_method'], pyparams['scaling_factor'],
+        pyparams['crop_size'], [float(m) for m in pyparams['im_mean']]], sort_keys = True)
+    settings = {'imlist': list(imlist), 'blobs': list(blobs), 'dtype': np.dtype(dtype).name, 'caffemodel': caffemodel, 'npoints': len(index),
+        'patches': hashlib.sha1(patch_key).hexdigest()}
+    nimages_done = 0
+    if os.path.isfile(progressfile):
+        with open(progressfile) as f:
+            progress = json.load(f)
+        if progress['settings'] == settings:
+            nimages_done = progress['nimages_done']
+    mode = 'r+' if nimages_done > 0 else 'w+'
+    features = dict([(blob, np.lib.format.open_memmap(os.path.join(outdir, blob + '.npy'), mode = mode, dtype = dtype, shape = (len(index), ) + net.blobs[blob].data.shape[1:])) for blob in blobs])
+    if nimages_done == 0:
+        np.save(os.path.join(outdir, 'index.npy'), index)
+        with open(os.path.join(outdir, 'imlist.txt'), 'w') as f:
+            f.write('\n'.join(imlist) + '\n')
+
+    print "extracting {} from {} images in {} using {}, starting at image {}".format(blobs, len(imlist), workdir, caffemodel, nimages_done)
+    for imcounter in tqdm(range(nimages_done, len(imlist))):
+        get_source(pyparams).prefetch(imlist[imcounter : imcounter + pyparams.get('readahead', 16)])
+        (patchlist, _) = _image_patches(imlist[imcounter], imdict, pyparams)
+        pos = image_offsets[imcounter]
+        for b in range(0, len(patchlist), batch_size):
+            batch = patchlist[b : b + batch_size]
+            for i, patch in enumerate(batch):
+                net.blobs['data'].data[i, ...] = transformer.preprocess(patch)
+            with trace.span('extract_features.forward'):
+                net.forward(start = startlayer)
+            for blob in blobs:
+                features[blob][pos + b : pos + b + len(batch)] = net.blobs[blob].data[:len(batch)]
+
+        # Flush the features before recording the progress, so a crash never leaves recorded rows unwritten.
+        for blob in blobs:
+            features[blob].flush()
+        with open(progressfile + '.tmp', 'w') as f:
+            json.dump({'settings': settings, 'nimages_done': imcounter + 1}, f)
+        os.rename(progressfile + '.tmp', progressfile)
+
+    del features
+    return (dict([(blob, np.load(os.path.join(outdir, blob + '.npy'), mmap_mode = 'r')) for blob in blobs]), index)
+
+
 def find_latest_caffemodel(workdir, snapshot_prefix = 'snapshot'):
     
     caffemodels = glob.glob("{}*.caffemodel".format(os.path.join(workdir, snapshot_prefix)))
@@ -487,6 +1231,108 @@ def find_latest_caffemodel(workdir, snapshot_prefix = 'snapshot'):
         return None
 
 
+def list_snapshots(workdir, snapshot_prefix = 'snapshot', min_age = 0):
+    """
+    Returns a list of (iter, caffemodel) of the {snapshot_prefix}*_iter_*.caffemodel files in workdir, sorted by iter (the naming of find_latest_caffemodel).
+    Files modified less than min_age seconds ago are left out, since caffe may still be writing them.
+    """
+    snapshots = []
+    for f in glob.glob("{}*.caffemodel".format(os.path.join(workdir, snapshot_prefix))):
+        match = re.search('iter_([0-9]+)', os.path.basename(f))
+        if match and os.path.getmtime(f) <= time.time() - min_age:
+            snapshots.append((int(match.group(1)), os.path.basename(f)))
+    return sorted(snapshots)
+
+
+def _read_metrics(metricsfile):
+    """
+    Reads the metrics table written by watch_snapshots. Returns a list of dicts, one per evaluated snapshot.
+    """
+    if not os.path.isfile(metricsfile):
+        return []
+    with open(metricsfile) as f:
+        rows = [line.split() for line in f if line.strip()]
+    return [{'iter': int(r[0]), 'caffemodel': r[1], 'accuracy': float(r[2]), 'npoints': int(r[3]), 'seconds': float(r[4])} for r in rows[1:]]
+
+
+def _evaluate_snapshot(queue, workdir, caffemodel, test_params, GPU_id, threads):
+    """
+    Runs in a child process of watch_snapshots. Evaluates caffemodel and puts the metrics on queue.
+    """
+    if threads is not None:
+        for var in ['OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS']:
+            os.environ[var] = str(threads)
+    t0 = timer()
+    params = dict(test_params)
+    params.update({'workdir': workdir, 'caffemodel': caffemodel, 'GPU_id': GPU_id})
+    prediction = classify_from_patchlist(**params) if 'pyparams' in params else classify(**params)
+    npoints = int(prediction[0].total()) if isinstance(prediction[0], confmatrix.ConfMatrix) else len(prediction[0])
+    queue.put({'accuracy': _prediction_accuracy(prediction), 'npoints': npoints, 'seconds': timer() - t0})
+
+
+def watch_snapshots(workdir, test_params, snapshot_prefix = 'snapshot', GPU_id = 0, threads = None, poll_interval = 60, min_age = 5, metricsfile = 'snapshot_metrics.txt', stop = None):
+    """
+    watch_snapshots evaluates the snapshots of a net while it trains. It polls workdir for new {snapshot_prefix}*_iter_*.caffemodel files, and evaluates each in a separate process, on its own device (or CPU threads).
+    The results are appended to a metrics table in workdir. Snapshots that are already in the table are skipped. If several new snapshots show up while an evaluation runs, only the newest is evaluated.
+
+    Takes
+    workdir: directory where the net trains (e.g. by run or cycle_runs, in another process).
+    test_params: dict passed on to classify_from_patchlist if it has a 'pyparams' entry, else to classify. The workdir, caffemodel and GPU_id are set by watch_snapshots.
+    GPU_id: device for the evaluations, None for CPU mode.
+    threads: if given, the number of BLAS / OpenMP threads of the evaluation process.
+    poll_interval: seconds between polls.
+    min_age: snapshots modified less than min_age seconds ago are not evaluated yet, as caffe may still be writing them.
+    metricsfile: name of the metrics table in workdir. One line per snapshot, with iter, caffemodel, accuracy, number of test points and evaluation time.
+    stop: callable. The watcher returns when stop() is True, after evaluating the newest snapshot. By default it runs forever.
+
+    Gives
+    list of dicts, one per row of the metrics table.
+
+    Usage
+    watcher = multiprocessing.Process(target = watch_snapshots, args = (workdir, test_params), kwargs = {'GPU_id': 1})
+    watcher.start()
+    run(workdir, GPU_id = 0)
+    """
+    metricspath = os.path.join(workdir, metricsfile)
+    if not os.path.isfile(metricspath):
+        with open(metricspath, 'w') as f:
+            f.write('iter caffemodel accuracy npoints seconds\n')
+    done = set([row['iter'] for row in _read_metrics(metricspath)])
+    last_started = max(done) if done else -1
+    queue = multiprocessing.Queue()
+    (process, current) = (None, None)
+    while True:
+        stopping = stop is not None and stop()
+
+        # collect the result of the running evaluation.
+        if process is not None and not process.is_alive():
+            process.join()
+            try:
+                result = queue.get(timeout = 1)
+                with open(metricspath, 'a') as f:
+                    f.write('{} {} {:.6f} {} {:.1f}\n'.format(current[0], current[1], result['accuracy'], result['npoints'], result['seconds']))
+                print "{}: {} accuracy {:.4f} ({:.0f} s)".format(workdir, current[1], result['accuracy'], result['seconds'])
+            except Empty:
+                print "{}: evaluation of {} failed.".format(workdir, current[1])
+            (process, current) = (None, None)
+
+        # start on the newest unevaluated snapshot.
+        if process is None:
+            pending = [s for s in list_snapshots(workdir, snapshot_prefix, min_age = 0 if stopping else min_age) if s[0] > last_started and not s[0] in done]
+            if pending:
+                if len(pending) > 1:
+                    print "{}: skipping {}, evaluating the newest snapshot.".format(workdir, [c for (_, c) in pending[:-1]])
+                current = pending[-1]
+                last_started = current[0]
+                process = multiprocessing.Process(target = _evaluate_snapshot, args = (queue, workdir, current[1], test_params, GPU_id, threads))
+                process.start()
+                continue
+            elif stopping:
+                break
+        time.sleep(poll_interval)
+    return _read_metrics(metricspath)
+
+
 def calculate_image_mean(imlist): 
     """
     Returns mean channel intensity across the images in imlist.
@@ -688,3 +1534,230 @@ def residual_net(total_depth, data_layer_params, num_classes = 1000, acclayer =
 
     return n            
 
+
+
+
+# ==============================================================================
+# ============================ STATIC NET ANALYSIS =============================
+# ==============================================================================
+
+# Shapes of the tops of the python data layers in beijbom_caffe_data_layers, as a function of their param_str dict.
+python_layer_top_shapes = {
+    'RandomPointDataLayer': lambda p: [(p['batch_size'], 3, p['crop_size'], p['crop_size']), (p['batch_size'], 1)],
+    'ImageNetDataLayer': lambda p: [(p['batch_size'], 3, p['crop_size'], p['crop_size']), (p['batch_size'], 1)],
+    'MultiScalePointDataLayer': lambda p: [(p['batch_size'], 3, cs, cs) for cs in p['crop_sizes']] + [(p['batch_size'], 1)],
+    'ConfMatrixLayer': lambda p: [(1, )],
+    'RandomPointRegressionDataLayer': lambda p: [(p['batch_size'], 3) + tuple(p['im_shape']), (p['batch_size'], p['nclasses'])],
+    'RandomPointMultiLabelDataLayer': lambda p: [(p['batch_size'], 3) + tuple(p['im_shape']), (p['batch_size'], p['nclasses'])],
+}
+
+
+def read_net_proto(net):
+    """
+    Returns a caffe NetParameter from INPUT net, which can be a caffe.NetSpec, a NetParameter or a path to a prototxt file.
+    """
+    from caffe.proto import caffe_pb2
+    from google.protobuf import text_format
+
+    if isinstance(net, caffe.NetSpec):
+        return net.to_proto()
+    if isinstance(net, caffe_pb2.NetParameter):
+        return net
+    proto = caffe_pb2.NetParameter()
+    with open(net, 'r') as f:
+        text_format.Merge(f.read(), proto)
+    return proto
+
+
+def _spatial_param(values, default):
+    """
+    Helper for the repeated kernel_size, pad and stride fields of the ConvolutionParameter.
+    """
+    values = list(values)
+    if len(values) == 0:
+        return (default, default)
+    if len(values) == 1:
+        return (values[0], values[0])
+    return tuple(values[:2])
+
+
+def _layer_cost(layer, bottom_shapes, input_shapes):
+    """
+    Returns (top_shapes, nparams, flops, workspace) for a single caffe LayerParameter given the shapes of its bottoms.
+    flops counts multiplications and additions separately, so a multiply-accumulate is 2 flops.
+    workspace is the size (in elements) of the im2col buffer caffe allocates for convolutions.
+    """
+    ltype = layer.type
+    nparams, flops, workspace = 0, 0, 0
+    numel = lambda shape: int(np.prod(shape))
+
+    if ltype in ('Python', 'Input', 'Data', 'ImageData', 'MemoryData', 'HDF5Data'):
+        if all(top in input_shapes for top in layer.top):
+            top_shapes = [tuple(input_shapes[top]) for top in layer.top]
+        elif ltype == 'Python' and layer.python_param.layer in python_layer_top_shapes:
+            top_shapes = python_layer_top_shapes[layer.python_param.layer](eval(layer.python_param.param_str))
+        elif ltype == 'Input':
+            top_shapes = [tuple(shape.dim) for shape in layer.input_param.shape]
+        else:
+            raise ValueError("Can't infer top shapes of layer {} ({}). Pass them in input_shapes.".format(layer.name, ltype))
+
+    elif ltype in ('Convolution', 'Deconvolution'):
+        cp = layer.convolution_param
+        (n, c, h, w) = bottom_shapes[0]
+        kh, kw = (cp.kernel_h, cp.kernel_w) if cp.HasField('kernel_h') else _spatial_param(cp.kernel_size, 1)
+        ph, pw = (cp.pad_h, cp.pad_w) if cp.HasField('pad_h') else _spatial_param(cp.pad, 0)
+        sh, sw = (cp.stride_h, cp.stride_w) if cp.HasField('stride_h') else _spatial_param(cp.stride, 1)
+        dh, dw = _spatial_param(cp.dilation, 1)
+        ekh, ekw = dh * (kh - 1) + 1, dw * (kw - 1) + 1
+        if ltype == 'Convolution':
+            ho, wo = (h + 2 * ph - ekh) // sh + 1, (w + 2 * pw - ekw) // sw + 1
+            (spatial_in, spatial_out) = (ho * wo, ho * wo)
+        else:
+            ho, wo = sh * (h - 1) + ekh - 2 * ph, sw * (w - 1) + ekw - 2 * pw
+            (spatial_in, spatial_out) = (h * w, h * w)
+        nparams = cp.num_output * (c // cp.group) * kh * kw + (cp.num_output if cp.bias_term else 0)
+        flops = 2 * n * cp.num_output * spatial_in * (c // cp.group) * kh * kw
+        if not (kh == 1 and kw == 1 and sh == 1 and sw == 1 and ph == 0 and pw == 0):
+            workspace = (c // cp.group) * kh * kw * spatial_out * cp.group # 1x1 convolutions skip im2col.
+        top_shapes = [(n, cp.num_output, ho, wo)]
+
+    elif ltype == 'Pooling':
+        pp = layer.pooling_param
+        (n, c, h, w) = bottom_shapes[0]
+        if pp.global_pooling:
+            kh, kw, ph, pw, sh, sw = h, w, 0, 0, 1, 1
+        else:
+            kh, kw = (pp.kernel_h, pp.kernel_w) if pp.HasField('kernel_h') else (pp.kernel_size, pp.kernel_size)
+            ph, pw = (pp.pad_h, pp.pad_w) if pp.HasField('pad_h') else (pp.pad, pp.pad)
+            sh, sw = (pp.stride_h, pp.stride_w) if pp.HasField('stride_h') else (pp.stride, pp.stride)
+        # caffe rounds pooling output sizes up, but makes sure the last window starts inside the image.
+        ho = int(math.ceil(float(h + 2 * ph - kh) / sh)) + 1
+        wo = int(math.ceil(float(w + 2 * pw - kw) / sw)) + 1
+        if ph > 0 and (ho - 1) * sh >= h + ph:
+            ho -= 1
+        if pw > 0 and (wo - 1) * sw >= w + pw:
+            wo -= 1
+        top_shapes = [(n, c, ho, wo)]
+        flops = n * c * ho * wo * kh * kw
+
+    elif ltype == 'InnerProduct':
+        ip = layer.inner_product_param
+        shape = bottom_shapes[0]
+        axis = ip.axis % len(shape)
+        nin = numel(shape[axis:])
+        nouter = numel(shape[:axis])
+        nparams = nin * ip.num_output + (ip.num_output if ip.bias_term else 0)
+        flops = 2 * nouter * nin * ip.num_output
+        top_shapes = [tuple(shape[:axis]) + (ip.num_output, )]
+
+    elif ltype == 'BatchNorm':
+        top_shapes = [bottom_shapes[0]]
+        nparams = 2 * bottom_shapes[0][1] + 1 # mean, variance and the moving average factor.
+        flops = 2 * numel(bottom_shapes[0])
+
+    elif ltype == 'Scale':
+        top_shapes = [bottom_shapes[0]]
+        nparams = bottom_shapes[0][1] * (2 if layer.scale_param.bias_term else 1)
+        flops = numel(bottom_shapes[0]) * (2 if layer.scale_param.bias_term else 1)
+
+    elif ltype == 'LRN':
+        top_shapes = [bottom_shapes[0]]
+        flops = numel(bottom_shapes[0]) * (layer.lrn_param.local_size + 3)
+
+    elif ltype == 'Eltwise':
+        top_shapes = [bottom_shapes[0]]
+        flops = numel(bottom_shapes[0]) * (len(bottom_shapes) - 1)
+
+    elif ltype == 'Concat':
+        axis = layer.concat_param.axis
+        shape = list(bottom_shapes[0])
+        shape[axis] = sum([s[axis] for s in bottom_shapes])
+        top_shapes = [tuple(shape)]
+
+    elif ltype in ('ReLU', 'Dropout', 'Sigmoid', 'TanH', 'Softmax', 'Power', 'AbsVal', 'BNLL'):
+        top_shapes = [bottom_shapes[0]]
+        flops = numel(bottom_shapes[0])
+
+    elif ltype in ('SoftmaxWithLoss', 'EuclideanLoss', 'SigmoidCrossEntropyLoss', 'Accuracy'):
+        top_shapes = [()] * len(layer.top)
+        flops = 3 * numel(bottom_shapes[0])
+
+    else:
+        raise NotImplementedError("Layer type {} (layer {}) is not supported.".format(ltype, layer.name))
+
+    return (top_shapes, nparams, flops, workspace)
+
+
+def net_cost(net, input_shapes = {}, phase = 'train', bytes_per_element = 4, verbose = False):
+    """
+    net_cost estimates output shapes, parameter count, forward flops and memory use of a net without instantiating a caffe.Net.
+
+    Takes
+    net: caffe.NetSpec (e.g. from vgg or residual_net), NetParameter or path to a prototxt file.
+    input_shapes: dict mapping top names to shapes for data layers whose shapes can't be inferred from the prototxt.
+    phase: {'train' or 'test'}. In train phase, caffe also stores the gradient of each blob and the solver history of each parameter.
+    bytes_per_element: 4 for float, 8 for double.
+    verbose: If True, prints a table with the per-layer costs.
+
+    Gives
+    (layers, totals) tuple. layers is a list of dicts, one per layer, with keys 'name', 'type', 'top_shapes', 'params', 'flops' and 'activation_bytes'. totals is a dict with the totals across the net, including 'batch_size', 'param_bytes', 'workspace_bytes' and 'total_bytes'.
+    In-place layers (top == bottom, e.g. ReLU and Dropout as generated by conv_relu) don't allocate new activations.
+    """
+    assert phase in ('train', 'test')
+    proto = read_net_proto(net)
+    blob_copies = 2 if phase == 'train' else 1 # data (+ diff)
+    param_copies = 3 if phase == 'train' else 1 # data (+ diff + solver history)
+
+    shapes = {}
+    if len(proto.input) > 0: # deprecated input fields.
+        for i, name in enumerate(proto.input):
+            shapes[name] = tuple(proto.input_shape[i].dim) if len(proto.input_shape) > 0 else tuple(proto.input_dim[4 * i : 4 * i + 4])
+    shapes.update(input_shapes)
+
+    layers = []
+    workspace = 0
+    for layer in proto.layer:
+        include_phases = [rule.phase for rule in layer.include if rule.HasField('phase')]
+        if include_phases and not (0 if phase == 'train' else 1) in include_phases:
+            continue
+        bottom_shapes = [shapes[b] for b in layer.bottom]
+        (top_shapes, nparams, flops, layer_workspace) = _layer_cost(layer, bottom_shapes, shapes)
+        activation_elements = 0
+        for top, shape in zip(layer.top, top_shapes):
+            if not top in layer.bottom: # in-place layers re-use the bottom blob.
+                activation_elements += int(np.prod(shape))
+            shapes[top] = shape
+        workspace += layer_workspace # each convolution layer keeps its own buffer.
+        layers.append({'name': layer.name, 'type': layer.type, 'top_shapes': top_shapes, 'params': nparams, 'flops': flops,
+            'activation_bytes': activation_elements * bytes_per_element * blob_copies})
+
+    batch_sizes = [l['top_shapes'][0][0] for l in layers if len(l['top_shapes']) > 0 and len(l['top_shapes'][0]) > 0]
+    totals = {}
+    totals['batch_size'] = batch_sizes[0] if batch_sizes else 1
+    totals['params'] = sum([l['params'] for l in layers])
+    totals['flops'] = sum([l['flops'] for l in layers])
+    totals['activation_bytes'] = sum([l['activation_bytes'] for l in layers])
+    totals['param_bytes'] = totals['params'] * bytes_per_element * param_copies
+    totals['workspace_bytes'] = workspace * bytes_per_element
+    totals['total_bytes'] = totals['activation_bytes'] + totals['param_bytes'] + totals['workspace_bytes']
+
+    if verbose:
+        print "{:<20} {:<16} {:<22} {:>12} {:>10} {:>10}".format('layer', 'type', 'top shape', 'params', 'GFLOPs', 'MB')
+        for l in layers:
+            print "{:<20} {:<16} {:<22} {:>12} {:>10.3f} {:>10.1f}".format(l['name'], l['type'], str(l['top_shapes'][0]) if l['top_shapes'] else '', l['params'], l['flops'] / 1e9, l['activation_bytes'] / 2.0**20)
+        print "Total: {} params, {:.2f} GFLOPs, {:.1f} MB (batch size {}).".format(totals['params'], totals['flops'] / 1e9, totals['total_bytes'] / 2.0**20, totals['batch_size'])
+
+    return (layers, totals)
+
+
+def max_batch_size(net, memory_budget, input_shapes = {}, phase = 'train', bytes_per_element = 4):
+    """
+    Returns the largest batch size for which net fits in memory_budget (in bytes), according to net_cost.
+    Activation memory is assumed to scale linearly with the batch size, while parameter and workspace memory is constant.
+    """
+    (layers, totals) = net_cost(net, input_shapes = input_shapes, phase = phase, bytes_per_element = bytes_per_element)
+    per_instance_bytes = float(totals['activation_bytes']) / totals['batch_size']
+    fixed_bytes = totals['param_bytes'] + totals['workspace_bytes']
+    if fixed_bytes + per_instance_bytes > memory_budget:
+        return 0
+    return int((memory_budget - fixed_bytes) // per_instance_bytes)
@@ -1,42 +1,217 @@
+from __future__ import division
+import io
 import numpy as np
-import matplotlib.pyplot as plt
+from copy import deepcopy
 
+SPARSE_NCLASSES = 2048 # by default, matrices with more classes than this are stored sparse.
 
-class ConfMatrix:
+# 3x5 pixel bitmap font used by ConfMatrix.render. Glyph 10 is '%' and glyph 11 is blank.
+_FONT = np.array([[[int(p) for p in row] for row in glyph.split()] for glyph in [
+   '111 101 101 101 111', '010 110 010 010 111', '111 001 111 100 111', '111 001 111 001 111', '101 101 111 001 001',
+   '111 100 111 001 111', '111 100 111 101 111', '111 001 001 001 001', '111 101 111 101 111', '111 101 111 001 111',
+   '101 001 010 100 101', '000 000 000 000 000']], dtype = bool)
+
+
+class ConfMatrix(object):
    """
    This class can build and display a confusion matrix.
+
+   The counts are stored either as a dense nclasses x nclasses array, or sparse as the (sorted) flat indices gt * nclasses + est of the non-zero entries and their counts.
+   A sparse matrix switches to dense automatically once that is smaller. The metric methods work on both, while show, export, sort and cut use the dense matrix.
+   Matrices can be combined with merge (or +), and serialized with tobytes / frombytes, e.g. to accumulate results in separate processes.
    """
 
-   def __init__(self, nclasses, labelset = None):
+   def __init__(self, nclasses, labelset = None, sparse = None):
       self.nclasses = nclasses
       self.labelset = labelset
-      self.cm = np.zeros((nclasses, nclasses))
+      if sparse is None:
+         sparse = nclasses > SPARSE_NCLASSES
+      self.sparse = sparse
+      if sparse:
+         self._keys = np.zeros(0, dtype = np.int64)
+         self._counts = np.zeros(0, dtype = np.int64)
+      else:
+         self._cm = np.zeros((nclasses, nclasses), dtype = np.int64)
+
+   @property
+   def cm(self):
+      """
+      The dense count matrix. NOTE: For a sparse matrix, this allocates the full nclasses x nclasses array.
+      """
+      if self.sparse:
+         cm = np.zeros(self.nclasses * self.nclasses, dtype = self._counts.dtype)
+         cm[self._keys] = self._counts
+         return cm.reshape(self.nclasses, self.nclasses)
+      return self._cm
+
+   @cm.setter
+   def cm(self, cm):
+      self.sparse = False
+      self._cm = cm
+
+   def _densify(self):
+      self.cm = self.cm
 
-   def add(self, gtlabels, estlabels):
+   def _add_sparse(self, keys, counts):
+      """
+      Adds counts at flat indices keys to the sparse representation, and switches to dense if that takes less memory.
+      """
+      keys = np.concatenate((self._keys, keys))
+      counts = np.concatenate((self._counts, counts))
+      (self._keys, inverse) = np.unique(keys, return_inverse = True)
+      self._counts = np.bincount(inverse, weights = counts).astype(counts.dtype)
+      if 2 * self._keys.size >= self.nclasses * self.nclasses:
+         self._densify()
+
+   def _marginals(self):
+      """
+      Returns (diagonal, row sums, column sums, total) of the count matrix.
+      """
+      if not self.sparse:
+         return (np.diagonal(self._cm), self._cm.sum(axis = 1), self._cm.sum(axis = 0), np.sum(self._cm))
+      n = self.nclasses
+      (rows, cols) = (self._keys // n, self._keys % n)
+      ondiag = rows == cols
+      dtype = self._counts.dtype
+      diag = np.bincount(rows[ondiag], weights = self._counts[ondiag], minlength = n).astype(dtype)
+      gttotals = np.bincount(rows, weights = self._counts, minlength = n).astype(dtype)
+      esttotals = np.bincount(cols, weights = self._counts, minlength = n).astype(dtype)
+      return (diag, gttotals, esttotals, np.sum(self._counts))
+
+   def total(self):
+      """
+      Returns the total count, without densifying a sparse matrix.
+      """
+      return np.sum(self._counts) if self.sparse else np.sum(self._cm)
+
+   def add(self, gtlabels, estlabels, ignore_label = None, weights = None, chunk_size = 2**22):
       """
       This method adds data to the confusion matrix
 
       Takes
-      gtlabels: array of ground truth labels
+      gtlabels: array of ground truth labels. Can be of any shape, e.g. the label blob of a FCN.
       estlabels: array of estiamated labels of SAME SIZE as gtlabels
+      ignore_label: samples where gtlabels == ignore_label are not added.
+      weights: optional array of per-sample weights of SAME SIZE as gtlabels. Non-integer weights turn the count matrix into a float matrix.
+      chunk_size: number of samples to process at a time. This bounds the memory of the temporary arrays.
       """
 
-      if not len(gtlabels) == len(estlabels):
+      gtlabels = np.asarray(gtlabels).ravel()
+      estlabels = np.asarray(estlabels).ravel()
+      if not gtlabels.size == estlabels.size:
          raise Exception('intput gtlabels and estlabels must have the same length')
-      for (gtl, estl) in zip(gtlabels, estlabels):
-         self.cm[gtl, estl] += 1
+      if weights is not None:
+         weights = np.asarray(weights).ravel()
+         if not weights.size == gtlabels.size:
+            raise Exception('intput weights must have the same length as gtlabels')
+         if not np.issubdtype(weights.dtype, np.integer):
+            if self.sparse:
+               self._counts = self._counts.astype(np.float64)
+            else:
+               self._cm = self._cm.astype(np.float64)
+
+      n = self.nclasses
+      for start in range(0, gtlabels.size, chunk_size):
+         gt = gtlabels[start : start + chunk_size].astype(np.int64)
+         est = estlabels[start : start + chunk_size].astype(np.int64)
+         w = None if weights is None else weights[start : start + chunk_size]
+         if ignore_label is not None:
+            keep = gt != ignore_label
+            (gt, est) = (gt[keep], est[keep])
+            w = None if w is None else w[keep]
+         if gt.size == 0:
+            continue
+         if min(gt.min(), est.min()) < 0 or max(gt.max(), est.max()) >= n:
+            raise ValueError('labels must be in the range [0, nclasses)')
+         if self.sparse:
+            (keys, inverse) = np.unique(gt * n + est, return_inverse = True)
+            self._add_sparse(keys, np.bincount(inverse, weights = w).astype(self._counts.dtype))
+         else:
+            counts = np.bincount(gt * n + est, weights = w, minlength = n * n)
+            self._cm += counts.reshape(n, n).astype(self._cm.dtype)
       return self
 
+   def merge(self, other):
+      """
+      This method adds the counts of another ConfMatrix with the same number of classes to this one.
+      """
+      if not other.nclasses == self.nclasses:
+         raise ValueError('Can only merge confusion matrices with the same number of classes')
+      if other.sparse:
+         (keys, counts) = (other._keys, other._counts)
+      else:
+         keys = np.flatnonzero(other._cm)
+         counts = other._cm.ravel()[keys]
+      if self.sparse:
+         self._add_sparse(keys, counts.astype(np.result_type(self._counts, counts)))
+      else:
+         self._cm = self._cm.astype(np.result_type(self._cm, counts))
+         self._cm.flat[keys] += counts # keys are unique, so this is safe.
+      return self
+
+   def __iadd__(self, other):
+      return self.merge(other)
+
+   def __add__(self, other):
+      return deepcopy(self).merge(other)
+
+   def __radd__(self, other):
+      """ This makes sum() work on a list of ConfMatrix objects. """
+      if other == 0:
+         return deepcopy(self)
+      return deepcopy(other).merge(self)
+
+   def tobytes(self):
+      """
+      This method serializes the confusion matrix as a compressed list of its non-zero entries.
+      """
+      if self.sparse:
+         (keys, counts) = (self._keys, self._counts)
+      else:
+         keys = np.flatnonzero(self._cm)
+         counts = self._cm.ravel()[keys]
+      arrays = {'nclasses': np.asarray(self.nclasses), 'keys': keys, 'counts': counts}
+      if self.labelset is not None:
+         arrays['labelset'] = np.asarray(self.labelset)
+      buf = io.BytesIO()
+      np.savez_compressed(buf, **arrays)
+      return buf.getvalue()
+
+   @staticmethod
+   def frombytes(data, sparse = None):
+      """
+      Inverse of tobytes.
+      """
+      arrays = np.load(io.BytesIO(data))
+      cm = ConfMatrix(int(arrays['nclasses']), labelset = arrays['labelset'] if 'labelset' in arrays.files else None, sparse = sparse)
+      if cm.sparse:
+         cm._counts = cm._counts.astype(arrays['counts'].dtype)
+         cm._add_sparse(arrays['keys'], arrays['counts'])
+      else:
+         cm._cm = cm._cm.astype(arrays['counts'].dtype)
+         cm._cm.flat[arrays['keys']] = arrays['counts']
+      return cm
+
+   def save(self, filename):
+      with open(filename, 'wb') as f:
+         f.write(self.tobytes())
+
+   @staticmethod
+   def load(filename, sparse = None):
+      with open(filename, 'rb') as f:
+         return ConfMatrix.frombytes(f.read(), sparse = sparse)
+
    def sort(self, sort_index = None):
       if sort_index is None:
-         totals = cm.sum(axis=1)
+         totals = self.cm.sum(axis=1)
          sort_index = np.argsort(totals)[::-1]
       
       tmp = np.arange(self.cm.shape[0])
       cmperm = np.arange(self.cm.shape[0]);
       cmperm[sort_index] = tmp
       self.cm = self.collapse(cmperm)
-      self.labelset = self.labelset[sort_index]
+      if self.labelset is not None:
+         self.labelset = np.asarray(self.labelset)[sort_index]
       return self
 
    def cut(self, newsize):
@@ -49,7 +224,7 @@ class ConfMatrix:
 
 
 
-   def show(self, title='CM', collapsemap = None, cmap=plt.cm.Greys, normalize='recall', fontsize = 12, threshold = 0, title_with_acc = True):
+   def show(self, title='CM', collapsemap = None, cmap = None, normalize='recall', fontsize = 12, threshold = 0, title_with_acc = True):
       """
       This method plots the confusion matrix
 
@@ -61,32 +236,18 @@ class ConfMatrix:
       title_with_acc: {True, False}. If True, this appends accuracy and cohens kappa to the title.
 
       """
-      cm = self.cm
-      
+      import matplotlib.pyplot as plt
+      if cmap is None:
+         cmap = plt.cm.Greys
 
       plt.rcParams.update({'font.size': fontsize})
-      scale = 1
+      (cm, totals, scale) = self._normalize(normalize)
       nclasses = cm.shape[0]
-      if normalize == 'recall':
-         totals = cm.sum(axis=1)
-         cm = cm / totals[:, np.newaxis]
-         scale = 100
-      elif normalize == 'precision':
-         totals = cm.sum(axis=0)
-         cm = cm / totals[np.newaxis, :]
-         scale = 100
             
       plt.imshow(cm, interpolation='nearest', cmap=cmap)
       
       if(title_with_acc):
-         (acc, cok) = self.get_accuracy()
-         (cacc, ccok) = self.get_class_accuracy()
-         recalls = self.get_class_recalls()
-         precisions = self.get_class_precisions()
-         f1s_denominator = precisions + recalls
-         f1s_denominator[f1s_denominator == 0] = 1
-         f1s = 2 * np.multiply(recalls, precisions) / f1s_denominator
-         title = title + " [A:{:.1f}%, K:{:.1f}%, mA:{:.1f}%, mK:{:.1f}%, mR:{:.1f}%, mP:{:.1f}%, mF1:{:.1f}%]".format(100*acc, 100*cok, 100*np.mean(cacc), 100*np.mean(ccok), 100*np.mean(recalls), 100*np.mean(precisions), 100 * np.mean(f1s))
+         title = self._title_with_acc(title)
       plt.title(title)
       
       tick_marks = np.arange(nclasses)
@@ -113,18 +274,122 @@ class ConfMatrix:
       plt.ylabel('True label')
       plt.xlabel('Predicted label')
 
+   def render(self, filename = None, title = 'CM', normalize = 'recall', cmap = 'Greys', threshold = 0, title_with_acc = True, font_scale = 1, dpi = 100):
+      """
+      This method is a fast alternative to show for matrices with many classes.
+      It draws the matrix and all cell labels into a raster image with numpy, so the figure only has a single imshow, and writes it without using pyplot.
+
+      Takes
+      filename: file to write the figure to. The format is given by the extension (e.g. png or svg). If None, the raster is returned instead.
+      normalize: {'recall' or 'precision' or None}. See show.
+      cmap: name of a matplotlib colormap.
+      threshold: threshold above which to display the classification rates in the grid
+      title_with_acc: {True, False}. If True, this appends accuracy and cohens kappa to the title.
+      font_scale: size of the cell labels, in raster pixels per font pixel.
+
+      Gives
+      (h x w x 3) uint8 raster of the matrix if filename is None.
+      """
+      import matplotlib.cm
+
+      (cm, totals, scale) = self._normalize(normalize)
+      n = cm.shape[0]
+
+      # color the cells the same way imshow does.
+      lut = np.uint8(255 * matplotlib.cm.get_cmap(cmap)(np.linspace(0, 1, 256))[:, :3])
+      finite = cm[np.isfinite(cm)]
+      (vmin, vmax) = (finite.min(), finite.max()) if finite.size > 0 else (0, 1)
+      colors = lut[np.uint8(255 * np.clip(np.nan_to_num((cm - vmin) / max(vmax - vmin, 1e-12)), 0, 1))]
+
+      # cell labels are right-aligned integers, followed by '%' for normalized matrices.
+      (rows, cols) = np.nonzero(np.abs(np.nan_to_num(scale * cm)) > threshold)
+      values = np.round(cm[rows, cols] * scale).astype(np.int64)
+      if totals is not None:
+         (trows, tcols) = (np.arange(n), np.ones(n, dtype = np.int64) * n) if normalize == 'recall' else (np.ones(n, dtype = np.int64) * n, np.arange(n))
+         (rows, cols) = (np.concatenate((rows, trows)), np.concatenate((cols, tcols)))
+         values = np.concatenate((values, np.round(totals).astype(np.int64)))
+      ndigits = len(str(values.max())) if values.size > 0 else 1
+      powers = 10 ** np.arange(ndigits - 1, -1, -1)
+      glyphs = (values[:, np.newaxis] // powers) % 10
+      glyphs[(values[:, np.newaxis] < powers) & (powers > 1)] = 11 # blank leading zeros
+      if scale == 100:
+         glyphs = np.hstack((glyphs, np.where(np.arange(values.size) < values.size - (0 if totals is None else n), 10, 11)[:, np.newaxis]))
+      text = _FONT[glyphs] # (nlabels, nchars, 5, 3)
+      text = np.pad(text, ((0, 0), (0, 0), (0, 0), (0, 1)), mode = 'constant').transpose(0, 2, 1, 3).reshape(len(values), 5, -1)[:, :, :-1]
+      text = text.repeat(font_scale, axis = 1).repeat(font_scale, axis = 2)
+
+      # assemble the raster. Totals go in an extra (white) row or column.
+      (th, tw) = text.shape[1:]
+      cs = tw + 2 * font_scale # cell size in pixels
+      shape = (n + (totals is not None and normalize == 'precision'), n + (totals is not None and normalize == 'recall'))
+      raster = np.ones((shape[0] * cs, shape[1] * cs, 3), dtype = np.uint8) * 255
+      raster[:n * cs, :n * cs] = colors.repeat(cs, axis = 0).repeat(cs, axis = 1)
+      top = (rows * cs + (cs - th) // 2)[:, np.newaxis, np.newaxis] + np.arange(th)[np.newaxis, :, np.newaxis]
+      left = (cols * cs + (cs - tw) // 2)[:, np.newaxis, np.newaxis] + np.arange(tw)[np.newaxis, np.newaxis, :]
+      (top, left) = np.broadcast_arrays(top, left)
+      raster[top, left] = 255
+      raster[top[text], left[text]] = (0, 0, 255)
+
+      if filename is None:
+         return raster
+
+      from matplotlib.figure import Figure
+      from matplotlib.backends.backend_agg import FigureCanvasAgg
+      fig = Figure(figsize = (raster.shape[1] / dpi + 2, raster.shape[0] / dpi + 2))
+      canvas = FigureCanvasAgg(fig)
+      ax = fig.add_subplot(111)
+      ax.imshow(raster, interpolation = 'nearest', extent = (-0.5, shape[1] - 0.5, shape[0] - 0.5, -0.5))
+      if self.labelset is not None:
+         ax.set_xticks(np.arange(n))
+         ax.set_xticklabels(self.labelset, rotation = 45)
+         ax.set_yticks(np.arange(n))
+         ax.set_yticklabels(self.labelset)
+      ax.set_title(self._title_with_acc(title) if title_with_acc else title)
+      ax.set_ylabel('True label')
+      ax.set_xlabel('Predicted label')
+      canvas.print_figure(filename, dpi = dpi, bbox_inches = 'tight')
+
+   def _normalize(self, normalize):
+      """
+      Returns (normalized matrix, totals, scale) as used by show and render.
+      """
+      cm = self.cm
+      (totals, scale) = (None, 1)
+      if normalize == 'recall':
+         totals = cm.sum(axis=1)
+         cm = cm / totals[:, np.newaxis]
+         scale = 100
+      elif normalize == 'precision':
+         totals = cm.sum(axis=0)
+         cm = cm / totals[np.newaxis, :]
+         scale = 100
+      return (cm, totals, scale)
+
+   def _title_with_acc(self, title):
+      (acc, cok) = self.get_accuracy()
+      (cacc, ccok) = self.get_class_accuracy()
+      recalls = self.get_class_recalls()
+      precisions = self.get_class_precisions()
+      f1s = self.get_class_f1s()
+      return title + " [A:{:.1f}%, K:{:.1f}%, mA:{:.1f}%, mK:{:.1f}%, mR:{:.1f}%, mP:{:.1f}%, mF1:{:.1f}%]".format(100*acc, 100*cok, 100*np.mean(cacc), 100*np.mean(ccok), 100*np.mean(recalls), 100*np.mean(precisions), 100 * np.mean(f1s))
+
    def get_class_accuracy(self, cm = None):
+      """
+      This method calculates the one-vs-rest accuracy and Cohens Kappa of each class.
+      This is the same as collapsing the confusion matrix to each class vs. the rest and calling get_accuracy, but computed for all classes at once from the diagonal and the row and column sums.
+      """
 
       if cm is None:
-         cm = self.cm
-
-      cok = np.zeros(self.nclasses)
-      acc = np.zeros(self.nclasses)
-      for i in range(self.nclasses):
-         collapsemap = np.zeros(self.nclasses, dtype = np.uint8)
-         collapsemap[i] = 1
-         cmtemp = self.collapse(collapsemap)
-         (acc[i], cok[i]) = self.get_accuracy(cm = cmtemp)
+         (diag, gttotals, esttotals, total) = self._marginals()
+      else:
+         (diag, gttotals, esttotals, total) = (np.diagonal(cm), cm.sum(axis = 1), cm.sum(axis = 0), np.sum(cm))
+
+      # entries of the one-vs-rest matrices are tp = diag, fn = gttotals - diag, fp = esttotals - diag, and tn = the rest.
+      acc = (total - gttotals - esttotals + 2 * diag) / total
+      pe = ((total - gttotals) * (total - esttotals) + gttotals * esttotals) / total**2
+      pe_denominator = 1 - pe
+      pe_denominator[pe == 1] = 1
+      cok = np.where(pe == 1, 1, (acc - pe) / pe_denominator)
       return (acc, cok)
 
 
@@ -133,13 +398,15 @@ class ConfMatrix:
       This method calculates accuracy and Cohens Kappa from the confusion matrix
       """
       if cm is None:
-         cm = self.cm
+         (diag, gttotals, esttotals, total) = self._marginals()
+      else:
+         (diag, gttotals, esttotals, total) = (np.diagonal(cm), cm.sum(axis = 1), cm.sum(axis = 0), np.sum(cm))
       
-      acc = np.sum(np.diagonal(cm))/np.sum(cm)
+      acc = np.sum(diag)/total
 
-      pgt = cm.sum(axis=1) / np.sum(cm) #probability of the ground truth to predict each class
+      pgt = gttotals / total #probability of the ground truth to predict each class
 
-      pest = cm.sum(axis=0) / np.sum(cm) #probability of the estimates to predict each class
+      pest = esttotals / total #probability of the estimates to predict each class
 
       pe = np.sum(pgt * pest) #probaility of randomly guessing the same thing!
 
@@ -151,33 +418,101 @@ class ConfMatrix:
       return (acc, cok)
 
    def collapse(self, collapsemap):
+      """
+      This method returns the confusion matrix with classes merged according to collapsemap.
+      Class i in the original matrix is merged into class collapsemap[i] in the output.
+      """
 
-      cmin = self.cm
+      collapsemap = np.asarray(collapsemap)
       nnew  = max(collapsemap) + 1
-      cmint = np.zeros((self.nclasses, nnew)) #intermediate representation
-      cmout = np.zeros((nnew, nnew))
+      if self.sparse:
+         (rows, cols) = (collapsemap[self._keys // self.nclasses], collapsemap[self._keys % self.nclasses])
+         cmout = np.bincount(rows * nnew + cols, weights = self._counts, minlength = nnew * nnew)
+         return cmout.astype(self._counts.dtype).reshape(nnew, nnew)
+      onehot = np.zeros((self.cm.shape[0], nnew), dtype = self.cm.dtype)
+      onehot[np.arange(self.cm.shape[0]), collapsemap] = 1
 
-      for i in range(nnew):
-         cmint[:, i] = np.sum(cmin[:, collapsemap == i], axis = 1)
-
-      for i in range(nnew):
-         cmout[i, :] = np.sum(cmint[collapsemap == i, :], axis = 0)
-
-      return cmout
+      return np.dot(onehot.T, np.dot(self.cm, onehot))
 
    def get_class_recalls(self):
-      cm = self.cm
-      totals = cm.sum(axis=1)
+      (diag, totals, _, _) = self._marginals()
       totals[totals == 0] = 1
-      cm = cm / totals[:, np.newaxis]
-      return(np.diag(cm))
+      return(diag / totals)
 
    def get_class_precisions(self):
-      cm = self.cm
-      totals = cm.sum(axis = 0)
+      (diag, _, totals, _) = self._marginals()
+      totals[totals == 0] = 1
+      return(diag / totals)
+
+   def get_class_f1s(self):
+      """
+      This method calculates the F1 score of each class, i.e. the harmonic mean of recall and precision.
+      """
+      (diag, gttotals, esttotals, _) = self._marginals()
+      totals = gttotals + esttotals
       totals[totals == 0] = 1
-      cm = cm / totals[:, np.newaxis]
-      return(np.diag(cm))
+      return(2 * diag / totals)
+
+   def bootstrap(self, nboot = 1000, alpha = 0.05, seed = None, chunk_size = None, max_bytes = 2**28):
+      """
+      This method calculates bootstrap confidence intervals of the metrics by resampling the count matrix.
+
+      Each resample draws sum(cm) samples from the multinomial distribution given by the normalized count matrix. Only the non-zero entries are drawn, since the others are always zero.
+      The resamples are drawn in batches of chunk_size, and the metrics are computed for the whole batch at once.
+
+      Takes
+      nboot: number of bootstrap resamples.
+      alpha: the intervals cover the central (1 - alpha) of the bootstrap distribution.
+      seed: seed of the random number generator.
+      chunk_size: number of resamples per batch. If not given, this is set so that a batch uses about max_bytes of memory.
+
+      Gives
+      dict with keys 'accuracy', 'kappa', 'mean_class_accuracy', 'mean_recall' and 'class_f1s'. Each value is an (estimate, lower, upper) tuple. For 'class_f1s' these are arrays with one entry per class.
+      """
+      n = self.nclasses
+      if self.sparse:
+         (keys, counts) = (self._keys, self._counts)
+      else:
+         keys = np.flatnonzero(self._cm)
+         counts = self._cm.ravel()[keys]
+      total = int(round(np.sum(counts)))
+      pvals = counts / np.sum(counts)
+      (rows, cols) = (keys // n, keys % n)
+      ondiag = rows == cols
+      if chunk_size is None:
+         chunk_size = int(max(1, max_bytes // (8 * (3 * keys.size + 6 * n))))
+      rng = np.random.RandomState(seed)
+
+      metrics = {'accuracy': [], 'kappa': [], 'mean_class_accuracy': [], 'mean_recall': [], 'class_f1s': []}
+      for start in range(0, nboot, chunk_size):
+         nb = min(chunk_size, nboot - start)
+         samples = rng.multinomial(total, pvals, size = nb) # (nb, nnz)
+         offsets = (np.arange(nb) * n)[:, np.newaxis]
+         marginal = lambda idx, weights: np.bincount((offsets + idx).ravel(), weights = weights.ravel(), minlength = nb * n).reshape(nb, n)
+         diag = marginal(rows[ondiag], samples[:, ondiag])
+         gttotals = marginal(rows, samples)
+         esttotals = marginal(cols, samples)
+
+         acc = diag.sum(axis = 1) / total
+         pe = np.sum(gttotals * esttotals, axis = 1) / total**2
+         pe_denominator = 1 - pe
+         pe_denominator[pe == 1] = 1
+         metrics['accuracy'].append(acc)
+         metrics['kappa'].append(np.where(pe == 1, 1, (acc - pe) / pe_denominator))
+         metrics['mean_class_accuracy'].append(np.mean((total - gttotals - esttotals + 2 * diag) / total, axis = 1))
+         gttotals[gttotals == 0] = 1
+         metrics['mean_recall'].append(np.mean(diag / gttotals, axis = 1))
+         f1_denominator = gttotals + esttotals
+         f1_denominator[f1_denominator == 0] = 1
+         metrics['class_f1s'].append(2 * diag / f1_denominator)
+
+      estimates = {'accuracy': self.get_accuracy()[0], 'kappa': self.get_accuracy()[1], 'mean_class_accuracy': np.mean(self.get_class_accuracy()[0]),
+         'mean_recall': np.mean(self.get_class_recalls()), 'class_f1s': self.get_class_f1s()}
+      intervals = {}
+      for (key, values) in metrics.items():
+         (lower, upper) = np.percentile(np.concatenate(values), [50 * alpha, 100 - 50 * alpha], axis = 0)
+         intervals[key] = (estimates[key], lower, upper)
+      return intervals
 
    def export(self, normalize='recall'):
 
@@ -0,0 +1,226 @@
+"""
+beijbom_image_source reads the images of an imlist from local paths, file:// urls or http(s):// urls.
+
+Remote images are fetched by a pool of threads, each keeping one keep-alive connection per host, and stored in a size-bounded disk cache with least-recently-used eviction.
+The data layers call prefetch() with the images they will use next (in sampler order), so that the fetching overlaps with training.
+
+The cache is a plain directory, so it can be shared by several processes (e.g. the classify_from_patchlist workers) on the same node.
+
+Usage
+source = get_source({'image_cachedir': '/tmp/images', 'image_cache_gb': 20})
+source.prefetch(imlist[:16])
+im = source.open(imlist[0])
+"""
+
+import os, glob, socket, hashlib, tempfile, threading, httplib, urllib, urlparse
+from Queue import Queue
+from StringIO import StringIO
+from PIL import Image
+
+DEFAULT_CACHEDIR = os.path.join(tempfile.gettempdir(), 'beijbom_image_cache')
+
+
+def is_remote(path):
+    return path.startswith('http://') or path.startswith('https://')
+
+
+class ImageSource(object):
+    """
+    ImageSource opens images from local paths, file:// or http(s):// urls. Remote images are cached on disk.
+    """
+
+    def __init__(self, cachedir = DEFAULT_CACHEDIR, cache_bytes = 10 * 2**30, nthreads = 8, timeout = 60):
+        self.cachedir = cachedir
+        self.cache_bytes = cache_bytes
+        self.nthreads = nthreads
+        self.timeout = timeout
+        if not os.path.isdir(cachedir):
+            os.makedirs(cachedir)
+        self._size = sum([os.path.getsize(f) for f in self._cachefiles()]) # estimate, corrected on each eviction.
+        self._start()
+
+    def _start(self):
+        """
+        Sets up the thread pool state. The threads themselves are started on the first prefetch.
+        """
+        self._pid = os.getpid()
+        self._lock = threading.Lock()
+        self._inflight = {} # url: threading.Event, set when the fetch is done.
+        self._pending = set() # cache paths that were prefetched, but not opened yet. Not evicted.
+        self._queue = Queue()
+        self._threads = []
+        self._local = threading.local() # the connections of each thread.
+
+    def _check_fork(self):
+        if self._pid != os.getpid():
+            # a forked process (e.g. a pool worker) does not inherit the fetch threads, so start over.
+            self._start()
+
+    def _cachefiles(self):
+        return [f for f in glob.glob(os.path.join(self.cachedir, '*')) if not f.endswith('.tmp')]
+
+    def cache_path(self, url):
+        """
+        Returns the path of url in the disk cache.
+        """
+        ext = os.path.splitext(urlparse.urlparse(url).path)[1]
+        return os.path.join(self.cachedir, hashlib.sha1(url).hexdigest() + ext)
+
+    def local_path(self, path):
+        """
+        Returns a local file path for INPUT path. Remote images are fetched, unless they are cached, or waited for if a prefetch is in progress.
+        """
+        if path.startswith('file://'):
+            return urllib.url2pathname(urlparse.urlparse(path).path)
+        if not is_remote(path):
+            return path
+        cached = self.cache_path(path)
+        self._check_fork()
+        with self._lock:
+            event = self._inflight.get(path)
+        if event is not None:
+            event.wait()
+        if os.path.isfile(cached):
+            os.utime(cached, None) # mark as recently used.
+            return cached
+        self._fetch(path) # not prefetched, or the prefetch failed.
+        return cached
+
+    def open(self, path):
+        """
+        Returns INPUT image as a (loaded) PIL image.
+        """
+        local = self.local_path(path)
+        try:
+            im = Image.open(local)
+            im.load()
+        except IOError:
+            if not is_remote(path):
+                raise
+            # the file may have been evicted (by another process) in between, so fetch it again, and decode it from memory.
+            im = Image.open(StringIO(self._fetch(path)))
+            im.load()
+        finally:
+            if is_remote(path):
+                with self._lock:
+                    self._pending.discard(self.cache_path(path))
+        return im
+
+    def prefetch(self, paths):
+        """
+        Queues the remote images in paths that are not cached or in flight for fetching by the thread pool. Returns immediately.
+        """
+        self._check_fork()
+        for path in paths:
+            if not is_remote(path) or os.path.isfile(self.cache_path(path)):
+                continue
+            with self._lock:
+                if path in self._inflight:
+                    continue
+                self._inflight[path] = threading.Event()
+                if len(self._threads) < self.nthreads:
+                    thread = threading.Thread(target = self._worker, name = 'ImageSource-{}'.format(len(self._threads)))
+                    thread.daemon = True
+                    thread.start()
+                    self._threads.append(thread)
+            self._queue.put(path)
+
+    def _worker(self):
+        while True:
+            url = self._queue.get()
+            try:
+                self._fetch(url, prefetched = True)
+            except Exception as e:
+                print "ImageSource: prefetch of {} failed: {}".format(url, e)
+            finally:
+                with self._lock:
+                    event = self._inflight.pop(url, None)
+                if event is not None:
+                    event.set()
+
+    def _connection(self, scheme, netloc, fresh = False):
+        """
+        Returns the keep-alive connection of this thread to netloc.
+        """
+        if not hasattr(self._local, 'connections'):
+            self._local.connections = {}
+        key = (scheme, netloc)
+        if fresh and key in self._local.connections:
+            self._local.connections.pop(key).close()
+        if key not in self._local.connections:
+            connection_class = httplib.HTTPSConnection if scheme == 'https' else httplib.HTTPConnection
+            self._local.connections[key] = connection_class(netloc, timeout = self.timeout)
+        return self._local.connections[key]
+
+    def _fetch(self, url, prefetched = False):
+        """
+        Downloads url to the disk cache, and returns its content.
+        """
+        parsed = urlparse.urlparse(url)
+        request_path = parsed.path + ('?' + parsed.query if parsed.query else '')
+        for attempt in range(2):
+            # the server may have closed the kept-alive connection, so retry once on a fresh one.
+            connection = self._connection(parsed.scheme, parsed.netloc, fresh = attempt > 0)
+            try:
+                connection.request('GET', request_path, headers = {'Connection': 'keep-alive'})
+                response = connection.getresponse()
+                data = response.read()
+                break
+            except (httplib.HTTPException, socket.error):
+                if attempt > 0:
+                    raise
+        if response.status != 200:
+            raise IOError("Can't fetch {}: HTTP {} {}".format(url, response.status, response.reason))
+
+        cached = self.cache_path(url)
+        tmpfile = '{}.{}.{}.tmp'.format(cached, os.getpid(), threading.current_thread().ident)
+        with open(tmpfile, 'wb') as f:
+            f.write(data)
+        os.rename(tmpfile, cached)
+        with self._lock:
+            self._size += len(data)
+            if prefetched:
+                self._pending.add(cached)
+            evict = self._size > self.cache_bytes
+        if evict:
+            self._evict(keep = cached)
+        return data
+
+    def _evict(self, keep = None):
+        """
+        Removes the least recently used files until the cache fits in cache_bytes.
+        keep (the file just fetched), the files being fetched and the prefetched files that are not opened yet are not removed, so the cache can exceed cache_bytes while they are in use.
+        """
+        with self._lock:
+            protected = set([keep]) | self._pending | set([self.cache_path(url) for url in self._inflight])
+            files = []
+            for f in self._cachefiles():
+                try:
+                    files.append((os.path.getmtime(f), os.path.getsize(f), f))
+                except OSError: # removed by another process.
+                    pass
+            files.sort()
+            self._size = sum([size for (_, size, _) in files])
+            for (_, size, f) in files:
+                if self._size <= self.cache_bytes:
+                    break
+                if f in protected:
+                    continue
+                try:
+                    os.remove(f)
+                except OSError:
+                    pass
+                self._size -= size
+
+
+_sources = {}
+
+def get_source(params = {}):
+    """
+    Returns the ImageSource for the 'image_cachedir', 'image_cache_gb' and 'fetch_threads' entries of INPUT params (e.g. the data layer params).
+    The source is shared by all callers in this process with the same settings.
+    """
+    key = (params.get('image_cachedir', DEFAULT_CACHEDIR), params.get('image_cache_gb', 10), params.get('fetch_threads', 8))
+    if key not in _sources:
+        _sources[key] = ImageSource(cachedir = key[0], cache_bytes = int(key[1] * 2**30), nthreads = key[2])
+    return _sources[key]
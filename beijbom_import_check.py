@@ -0,0 +1,58 @@
+"""
+beijbom_import_check measures the import time and memory of the beijbom modules, and checks them against a budget.
+Each module is imported in a fresh python process. The check fails if an import is too slow, uses too much memory, or loads one of the heavy modules (plotting, caffe) that should only be loaded on first use.
+
+Usage
+python beijbom_import_check.py
+"""
+
+import sys, json, subprocess
+
+# module: (max import time in seconds, max increase in peak RSS in MB)
+IMPORT_BUDGETS = {
+    'beijbom_misc_tools': (0.5, 40),
+    'beijbom_confmatrix': (0.3, 30),
+    'beijbom_caffe_tools': (0.6, 50),
+    'beijbom_trace': (0.1, 10),
+}
+
+# these should never be loaded as a side effect of importing the modules above.
+HEAVY_MODULES = ['matplotlib', 'pylab', 'caffe', 'skimage', 'tqdm']
+
+_MEASURE = """
+import sys, json, resource
+from timeit import default_timer as timer
+rss0 = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+t0 = timer()
+import {module}
+t1 = timer()
+rss1 = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+print json.dumps({{'time': t1 - t0, 'rss_mb': (rss1 - rss0) / 1024.0, 'modules': sorted(sys.modules.keys())}})
+"""
+
+
+def measure_import(module):
+    """
+    Imports INPUT module in a new python process and returns a dict with the import time (s), the increase in peak RSS (MB) and the loaded modules.
+    """
+    output = subprocess.check_output([sys.executable, '-c', _MEASURE.format(module = module)])
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def check_import_budgets(budgets = IMPORT_BUDGETS, heavy_modules = HEAVY_MODULES):
+    """
+    Checks each module in budgets. Prints a report and returns True if all modules are within budget.
+    """
+    ok = True
+    for module, (max_time, max_rss) in sorted(budgets.items()):
+        result = measure_import(module)
+        heavy = sorted(set([m.split('.')[0] for m in result['modules']]) & set(heavy_modules))
+        passed = result['time'] <= max_time and result['rss_mb'] <= max_rss and len(heavy) == 0
+        ok = ok and passed
+        print "{:<22} {:>6.3f} s (budget {:.2f}) {:>7.1f} MB (budget {}) {} {}".format(module, result['time'], max_time, result['rss_mb'], max_rss,
+            'OK' if passed else 'FAIL', 'loads: ' + ', '.join(heavy) if heavy else '')
+    return ok
+
+
+if __name__ == '__main__':
+    sys.exit(0 if check_import_budgets() else 1)
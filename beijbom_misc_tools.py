@@ -1,28 +1,167 @@
-import glob, os, math, colorsys, scipy, time
+import glob, os, math, time, struct, zlib, importlib, json
 from PIL import Image
 import numpy as np
-import matplotlib.pyplot as plt
-from pylab import *
 from copy import deepcopy
-import scipy.ndimage
-import pickle
+import cPickle as pickle
 
 """
 beijbom_pytools contains a bunch of nice misc python tools 
 """
 
 
-def psave(var, filename):
+class LazyModule(object):
     """
-    psave pickles and save var to filename
+    LazyModule is a stand-in for a module, or an attribute of a module, that is imported on first use.
+    This keeps heavy dependencies (matplotlib, caffe, ...) out of processes that never use them.
+
+    Example
+    plt = LazyModule('matplotlib.pyplot')
+    L = LazyModule('caffe', 'layers')
+    """
+    def __init__(self, name, attribute = None):
+        self.__dict__['_name'] = name
+        self.__dict__['_attribute'] = attribute
+        self.__dict__['_target'] = None
+
+    def _load(self):
+        if self._target is None:
+            module = importlib.import_module(self._name)
+            self.__dict__['_target'] = getattr(module, self._attribute) if self._attribute else module
+        return self._target
+
+    def __getattr__(self, key):
+        return getattr(self._load(), key)
+
+    def __call__(self, *args, **kwargs):
+        return self._load()(*args, **kwargs)
+
+
+plt = LazyModule('matplotlib.pyplot')
+scipy_misc = LazyModule('scipy.misc')
+
+
+PSAVE_MAGIC = 'BMTPSAVE' # first bytes of files written by psave that contain arrays.
+PSAVE_ALIGN = 64 # arrays are aligned to this many bytes in the file.
+
+
+class _ArrayRef(object):
+    """
+    Placeholder for an array (or a list of equally shaped arrays) that psave stores outside the pickle.
+    """
+    def __init__(self, index, aslist = False):
+        self.index = index
+        self.aslist = aslist
+
+
+def _is_plain_array(var):
+    """
+    True for numeric ndarrays (and memmaps). Subclasses like masked arrays and matrices carry more than the buffer, so they are left to the pickle.
+    """
+    return type(var) in (np.ndarray, np.memmap) and not var.dtype.hasobject
+
+
+def _extract_arrays(var, arrays):
+    """
+    Replaces the numeric ndarrays in (nested lists, tuples and dicts of) var by _ArrayRef placeholders, and appends the arrays to INPUT arrays.
+    Lists of arrays with the same shape and dtype, like the score lists from classify, are stacked to a single array.
+    """
+    if _is_plain_array(var):
+        arrays.append(var)
+        return _ArrayRef(len(arrays) - 1)
+    if type(var) is list:
+        if len(var) > 1 and all([_is_plain_array(v) for v in var]) and \
+            len(set([(v.shape, v.dtype.str) for v in var])) == 1:
+            arrays.append(np.stack(var))
+            return _ArrayRef(len(arrays) - 1, aslist = True)
+        return [_extract_arrays(v, arrays) for v in var]
+    if type(var) is tuple:
+        return tuple([_extract_arrays(v, arrays) for v in var])
+    if type(var) is dict:
+        return dict([(key, _extract_arrays(v, arrays)) for (key, v) in var.items()])
+    return var
+
+
+def _restore_arrays(var, arrays):
     """
-    pickle.dump(var, open(filename, 'wb'))
+    Inverse of _extract_arrays.
+    """
+    if isinstance(var, _ArrayRef):
+        return list(arrays[var.index]) if var.aslist else arrays[var.index]
+    if type(var) is list:
+        return [_restore_arrays(v, arrays) for v in var]
+    if type(var) is tuple:
+        return tuple([_restore_arrays(v, arrays) for v in var])
+    if type(var) is dict:
+        return dict([(key, _restore_arrays(v, arrays)) for (key, v) in var.items()])
+    return var
+
+
+def psave(var, filename, compress = False):
+    """
+    psave pickles and save var to filename.
+
+    Numeric ndarrays in var (also inside lists, tuples and dicts, but not subclasses like masked arrays) are stored as raw buffers next to the pickle, so they can be written and read at disk speed, and memory-mapped by pload.
+    If var contains no arrays, it is pickled with the highest protocol.
+
+    Takes
+    var: variable to save.
+    filename: file to save to.
+    compress: {False, True or 1-9}. If set, array buffers are zlib compressed (True means level 1). Compressed arrays can't be memory-mapped.
+    """
+    arrays = []
+    skeleton = _extract_arrays(var, arrays)
+    if len(arrays) == 0:
+        with open(filename, 'wb') as f:
+            pickle.dump(var, f, pickle.HIGHEST_PROTOCOL)
+        return
+
+    level = 1 if compress is True else int(compress)
+    with open(filename, 'wb') as f:
+        f.write(PSAVE_MAGIC)
+        arrayinfo = []
+        for var in arrays:
+            arr = np.ascontiguousarray(var) # NOTE: this makes 0-d arrays 1-d, so the shape is taken from var.
+            f.write('\0' * (-f.tell() % PSAVE_ALIGN))
+            offset = f.tell()
+            if level > 0:
+                f.write(zlib.compress(arr.tostring(), level))
+            else:
+                arr.tofile(f)
+            # the descr, unlike dtype.str, keeps the fields of structured dtypes.
+            arrayinfo.append((np.lib.format.dtype_to_descr(var.dtype), var.shape, offset, f.tell() - offset, level > 0))
+        header_offset = f.tell()
+        pickle.dump((skeleton, arrayinfo), f, pickle.HIGHEST_PROTOCOL)
+        f.write(struct.pack('<Q', header_offset))
 
-def pload(filename):
+
+def pload(filename, mmap_mode = None):
     """
-    pload opens and unpickles content of filename
+    pload opens and unpickles content of filename.
+
+    Takes
+    filename: file written by psave or any pickle file.
+    mmap_mode: {None, 'r', 'r+', 'c'}. If set, uncompressed arrays are memory-mapped (see np.memmap) instead of read, so they are only loaded from disk when accessed.
     """
-    return pickle.load(open(filename, 'rb'))
+    with open(filename, 'rb') as f:
+        if not f.read(len(PSAVE_MAGIC)) == PSAVE_MAGIC: # regular pickle.
+            f.seek(0)
+            return pickle.load(f)
+        f.seek(-8, 2)
+        f.seek(struct.unpack('<Q', f.read(8))[0])
+        (skeleton, arrayinfo) = pickle.load(f)
+        arrays = []
+        for (descr, shape, offset, nbytes, compressed) in arrayinfo:
+            dtype = np.lib.format.descr_to_dtype(descr)
+            if compressed:
+                f.seek(offset)
+                arr = np.frombuffer(bytearray(zlib.decompress(f.read(nbytes))), dtype = dtype).reshape(shape)
+            elif mmap_mode is not None and nbytes > 0:
+                arr = np.memmap(filename, dtype = dtype, mode = mmap_mode, offset = offset, shape = shape)
+            else:
+                f.seek(offset)
+                arr = np.fromfile(f, dtype = dtype, count = int(np.prod(shape))).reshape(shape)
+            arrays.append(arr)
+    return _restore_arrays(skeleton, arrays)
 
 
 def coral_image_resize(im, scaling_method, scaling_factor, height_cm):
@@ -34,7 +173,7 @@ def coral_image_resize(im, scaling_method, scaling_factor, height_cm):
        scale = scaling_factor # here scaling_factor is the desired image scaling.
     elif scaling_method == 'ratio':
         scale = scaling_factor * height_cm / im.shape[0] # here scaling_factor is the desited px_cm_ratio.
-    im = scipy.misc.imresize(im, scale)
+    im = scipy_misc.imresize(im, scale)
     return (im, scale)
 
 def crop_center(im, ps):
@@ -60,16 +199,36 @@ def crop_and_rotate(im, center, ps, angle, tile = False):
         offset = np.asarray(im.shape[:2])
         center = [offset[0] + center[0], offset[1] + center[0]]
         im = tile_image(im)
+    return(crop_center(rotate_with_PIL(_crop_big_patch(im, center, ps), angle), ps))
+
+def _crop_big_patch(im, center, ps):
+    """
+    crops the patch around center that is large enough to hold a ps patch at any rotation.
+    """
     tmp = ((math.ceil(ps * 2**.5) + 1) // 2 ) * 2 # round up and make even
     psbig = int(tmp) if ps % 2 == 0 else int(tmp) + 1
     el = [psbig / 2, psbig/2] if psbig % 2 == 0 else [psbig / 2, psbig/2 + 1] # edge length
-    bigpatch = im[center[0] - el[0] : center[0] + el[1], center[1] - el[0]:center[1] + el[1], :] # crop big patch
-    return(crop_center(rotate_with_PIL(bigpatch, angle), ps))
+    return im[center[0] - el[0] : center[0] + el[1], center[1] - el[0]:center[1] + el[1], :] # crop big patch
+
+def crop_variants(im, center, ps, variants):
+    """
+    crop_variants returns one patch per (angle, flip) in variants, as crop_and_rotate(im, center, ps, angle), mirrored left-right if flip.
+    The big patch is only cropped once, and rotated once per distinct angle.
+    """
+    if not type(ps) == int:
+        raise TypeError('INPUT ps must be a scalar')
+    bigpatch = _crop_big_patch(im, center, ps)
+    rotated = {}
+    patches = []
+    for (angle, flip) in variants:
+        if angle not in rotated:
+            rotated[angle] = crop_center(rotate_with_PIL(bigpatch, angle), ps)
+        patches.append(rotated[angle][:, ::-1] if flip else rotated[angle])
+    return patches
 
 def rotate_with_PIL(im, angle):
     im = Image.fromarray(im)
-    im.rotate(angle)
-    return np.asarray(im)
+    return np.asarray(im.rotate(angle))
 
 def tile_image(im):
     """
@@ -106,27 +265,52 @@ def vis_square(data, padsize=1, padval=0, scale = 1):
     
     plt.imshow(data)
 
-def int_to_rgb(im, bg_color = 0, ignore = 255):
+def row_chunks(nrows, chunk_rows):
+    """
+    Returns a list of (start, stop) row ranges of at most chunk_rows rows that cover nrows rows.
+    """
+    return [(start, min(start + chunk_rows, nrows)) for start in range(0, nrows, chunk_rows)]
+
+
+def int_to_rgb(im, bg_color = 0, ignore = 255, nlabels = None, out = None, chunk_rows = None):
     """
     Converts integer valued np image array to an rgb color image.
+    The colors are looked up in a table, one block of rows at a time, so im and out can be large memory-mapped arrays.
 
     Takes
     im: (w x h) uint8, nparray image
+    nlabels: number of labels to make colors for. If not given, this is the largest label in im (other than ignore) + 1.
+    out: optional (w x h x 3) uint8 array (e.g. a np.memmap) to write the output to.
+    chunk_rows: number of rows to process at a time. If not given, about 16M pixels are processed at a time.
 
     Gives
     (w x h x 3) uint8, nparray image
     """
-    gt_vals = np.setdiff1d(np.unique(im), ignore)
-    RGB_tuples = get_good_colors(np.max(gt_vals) + 1)
-
-    
     w, h = im.shape
-    ret = np.ones((w, h, 3), dtype=np.uint8) * bg_color
-
-    for label in gt_vals:
-        ret[im == label] = RGB_tuples[label, :]
+    chunks = row_chunks(w, chunk_rows or max(1, 2**24 // h))
+
+    # find the largest label and the largest value in im.
+    maxlabel, maxval = -1, 0
+    for (start, stop) in chunks:
+        chunk = im[start:stop]
+        maxval = max(maxval, int(chunk.max()))
+        labels = chunk[chunk != ignore]
+        if labels.size > 0:
+            maxlabel = max(maxlabel, int(labels.max()))
+    if nlabels is None:
+        nlabels = maxlabel + 1
+
+    lut = np.ones((max(maxval, nlabels - 1) + 1, 3), dtype=np.uint8) * bg_color
+    lut[:nlabels] = get_good_colors(nlabels)
+    if 0 <= ignore < lut.shape[0]:
+        lut[ignore] = bg_color
+
+    if out is None:
+        out = np.empty((w, h, 3), dtype=np.uint8)
+    for (start, stop) in chunks:
+        out[start:stop] = lut[im[start:stop]]
         
-    return ret
+    return out
 
 
 def softmax(w):
@@ -139,8 +323,13 @@ def get_good_colors(N):
     """
     This nifty function returns optimally different N colors.
     """
-    HSV_tuples = [(x*1.0/N, 0.5, 1) for x in range(N)]
-    return(255 * np.array(map(lambda x: colorsys.hsv_to_rgb(*x), HSV_tuples)))
+    # same as colorsys.hsv_to_rgb(x*1.0/N, 0.5, 1), for all x at once. Keep the order of the float operations, so the colors are bit-identical.
+    hue = (np.arange(N) * 1.0 / N) * 6.0
+    sector = np.floor(hue).astype(int) % 6
+    f = hue - np.floor(hue)
+    (v, p, q, t) = (np.ones(N), np.ones(N) * 0.5, 1 - 0.5 * f, 1 - 0.5 * (1 - f))
+    rgb = np.array([[v, t, p], [q, v, p], [p, v, t], [p, q, v], [t, p, v], [v, p, q]]) # (6, 3, N)
+    return(255 * rgb[sector, :, np.arange(N)])
 
 
 def slice_image(im, target_size = [1024, 1024], padcolor = [126, 148, 137]):
@@ -179,21 +368,125 @@ def slice_image(im, target_size = [1024, 1024], padcolor = [126, 148, 137]):
 
 
 
-def hist_stretch(im):
+def hist_stretch(im, out = None, chunk_rows = None):
   """
-  performs simple histogram stretch
+  performs simple histogram stretch of uint8 image im.
+  The histogram is accumulated and the stretch applied one block of rows at a time, so im and out (if given) can be large memory-mapped arrays.
   """
 
-  hist,bins = np.histogram(im.flatten(),256,[0,256])
+  chunks = row_chunks(im.shape[0], chunk_rows or max(1, 2**24 // max(1, im[0].size)))
+  hist = np.zeros(256, dtype=np.int64)
+  for (start, stop) in chunks:
+    hist += np.bincount(im[start:stop].ravel(), minlength=256)[:256]
   cdf = hist.cumsum()
   cdf_m = np.ma.masked_equal(cdf,0)
   cdf_m = (cdf_m - cdf_m.min())*255/(cdf_m.max()-cdf_m.min())
   cdf = np.ma.filled(cdf_m,0).astype('uint8')
 
-  return cdf[im]
+  if out is None:
+    out = np.empty(im.shape, dtype=np.uint8)
+  for (start, stop) in chunks:
+    out[start:stop] = cdf[im[start:stop]]
+  return out
 
 
 def acc(gt, est):
     if not len(gt) == len(est):
         raise ValueError('input gt and est must have the same length')
     return float(sum([(g == e) for (g,e) in zip(gt, est)])) / len(gt)
+
+
+class FeistelPermutation(object):
+    """
+    FeistelPermutation is a seeded pseudo-random permutation of range(n), computed one index at a time in O(1) time and memory.
+    It is a balanced Feistel network over the smallest even number of bits that covers n, with cycle walking to stay inside range(n).
+    """
+
+    def __init__(self, n, seed, rounds = 4):
+        self.n = n
+        bits = max(2, int(n - 1).bit_length())
+        self.half = (bits + 1) // 2
+        self.mask = (1 << self.half) - 1
+        self.keys = [int(k) for k in np.random.RandomState(seed).randint(0, 2**31 - 1, size = rounds)]
+
+    def _encrypt(self, x):
+        (left, right) = (x >> self.half, x & self.mask)
+        for key in self.keys:
+            h = ((right ^ key) * 0x45d9f3b) & 0xffffffff
+            h ^= h >> 16
+            (left, right) = (right, left ^ (h & self.mask))
+        return (left << self.half) | right
+
+    def __call__(self, i):
+        """
+        Returns the image of INPUT index i under the permutation.
+        """
+        x = self._encrypt(i)
+        while x >= self.n: # at most a few steps, since the domain is less than 4 * n.
+            x = self._encrypt(x)
+        return x
+
+
+class DataCursor(object):
+    """
+    DataCursor is a seeded, counter-based position in the data stream of a data layer.
+    Sample position p of the stream is image FeistelPermutation(n, [seed, epoch])(p % n), with epoch = p // n, so each epoch visits every image once in a new order.
+    The augmentation draws of batch b come from RandomState([seed, b]). Both can be computed for any batch directly, so a resumed run continues the stream exactly.
+
+    The seed and the next batch are stored in cursorfile (if given). run() sets the batch when it resumes from a snapshot.
+    """
+
+    def __init__(self, n, seed = None, cursorfile = None):
+        self.n = n
+        self.cursorfile = cursorfile
+        if cursorfile is not None and os.path.isfile(cursorfile):
+            with open(cursorfile) as f:
+                state = json.load(f)
+            (self.seed, self.batch) = (state['seed'], state['batch'])
+        else:
+            self.seed = int(np.random.randint(2**31 - 1)) if seed is None else seed
+            self.batch = 0
+            if cursorfile is not None:
+                DataCursor.write(cursorfile, self.seed, self.batch)
+        self._epoch = None
+
+    @staticmethod
+    def write(cursorfile, seed, batch):
+        with open(cursorfile + '.tmp', 'w') as f:
+            json.dump({'seed': seed, 'batch': batch}, f)
+        os.rename(cursorfile + '.tmp', cursorfile)
+
+    @staticmethod
+    def set_batch(cursorfile, batch):
+        """
+        Sets the next batch of an existing cursorfile.
+        """
+        with open(cursorfile) as f:
+            state = json.load(f)
+        DataCursor.write(cursorfile, state['seed'], batch)
+
+    def indices(self, start, count):
+        """
+        Returns the image indices of stream positions start to start + count.
+        """
+        result = []
+        for p in range(start, start + count):
+            (epoch, i) = divmod(p, self.n)
+            if epoch != self._epoch:
+                (self._epoch, self._permutation) = (epoch, FeistelPermutation(self.n, [self.seed, epoch]))
+            result.append(self._permutation(i))
+        return result
+
+    def rng(self, batch):
+        """
+        Returns the random state for the augmentation draws of INPUT batch.
+        """
+        return np.random.RandomState([self.seed, batch])
+
+    def next_batch(self):
+        """
+        Returns (batch, rng) for the next batch, and advances the cursor.
+        """
+        batch = self.batch
+        self.batch += 1
+        return (batch, self.rng(batch))
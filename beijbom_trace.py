@@ -0,0 +1,209 @@
+"""
+beijbom_trace is a lightweight tracing registry for the beijbom tools.
+It records spans (timed sections), counters and gauges, tagged with the process and thread they ran in, and exports them to Chrome trace json (open in chrome://tracing or Perfetto) or an aggregated summary table.
+
+Tracing is off by default. When it is off, span() returns a shared no-op object and the other calls return immediately.
+
+Worker processes (e.g. the classify_from_patchlist pool) record into their own registry. If tracing is enabled with a tracedir, each process writes its events there on flush(), and export_chrome / summary merge them.
+
+Usage
+import beijbom_trace as trace
+trace.enable(tracedir = '/tmp/trace')
+with trace.span('load', imname = imname):
+    ...
+@trace.traced('classify')
+def classify(...):
+    ...
+trace.counter('images')
+trace.export_chrome('trace.json')
+trace.summary()
+"""
+
+import os, json, time, glob, threading
+from functools import wraps
+
+_state = {'enabled': False, 'tracedir': None, 'pid': os.getpid()}
+_events = []
+_counters = {}
+_lock = threading.Lock()
+_local = threading.local()
+
+
+def enable(tracedir = None):
+    """
+    Turns tracing on. If tracedir is given, flush() writes the events of each process to tracedir.
+    """
+    if tracedir is not None and not os.path.isdir(tracedir):
+        os.makedirs(tracedir)
+    _state.update({'enabled': True, 'tracedir': tracedir})
+
+
+def disable():
+    _state['enabled'] = False
+
+
+def is_enabled():
+    return _state['enabled']
+
+
+def reset():
+    """
+    Clears the recorded events and counters of this process.
+    """
+    with _lock:
+        del _events[:]
+        _counters.clear()
+
+
+def _check_fork():
+    """
+    A forked process inherits the events and counters of its parent. Drop them, so that they are not flushed twice.
+    """
+    if _state['pid'] != os.getpid():
+        _state['pid'] = os.getpid()
+        reset()
+
+
+def _record(event):
+    _check_fork()
+    event['pid'] = os.getpid()
+    event['tid'] = threading.current_thread().ident
+    if getattr(_local, 'named', None) != event['pid']:
+        # name the thread once, so that the trace viewer shows e.g. the data layer workers by name.
+        _local.named = event['pid']
+        _events.append({'name': 'thread_name', 'ph': 'M', 'pid': event['pid'], 'tid': event['tid'], 'args': {'name': threading.current_thread().name}})
+    _events.append(event)
+
+
+class _NullSpan(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+_NULL_SPAN = _NullSpan()
+
+
+class _Span(object):
+    def __init__(self, name, args):
+        self.name = name
+        self.args = args
+
+    def __enter__(self):
+        self.t0 = time.time()
+        return self
+
+    def __exit__(self, *exc):
+        t1 = time.time()
+        _record({'name': self.name, 'ph': 'X', 'ts': 1e6 * self.t0, 'dur': 1e6 * (t1 - self.t0), 'args': self.args})
+        return False
+
+
+def span(name, **args):
+    """
+    Returns a context manager that records the time spent inside it as a span called name. Keyword arguments are stored with the span.
+    """
+    if not _state['enabled']:
+        return _NULL_SPAN
+    return _Span(name, args)
+
+
+def traced(name = None):
+    """
+    Decorator that records each call of the function as a span. name defaults to the function name.
+    """
+    def decorator(func):
+        span_name = func.__name__ if name is None else name
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            if not _state['enabled']:
+                return func(*args, **kwargs)
+            with _Span(span_name, {}):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def counter(name, value = 1):
+    """
+    Adds value to the counter called name (per process), and records its new total.
+    """
+    if not _state['enabled']:
+        return
+    _check_fork()
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + value
+        total = _counters[name]
+    _record({'name': name, 'ph': 'C', 'ts': 1e6 * time.time(), 'args': {name: total}})
+
+
+def gauge(name, value):
+    """
+    Records the current value of the gauge called name, e.g. a queue length.
+    """
+    if not _state['enabled']:
+        return
+    _record({'name': name, 'ph': 'C', 'ts': 1e6 * time.time(), 'args': {name: value}})
+
+
+def flush():
+    """
+    Appends the events of this process to its file in tracedir and clears them. Does nothing without a tracedir.
+    """
+    if not _state['enabled'] or _state['tracedir'] is None:
+        return
+    _check_fork()
+    with _lock:
+        events = list(_events)
+        del _events[:]
+    with open(os.path.join(_state['tracedir'], 'trace_{}.jsonl'.format(os.getpid())), 'a') as f:
+        for event in events:
+            f.write(json.dumps(event) + '\n')
+
+
+def events(tracedir = None):
+    """
+    Returns the events of this process, plus the ones flushed to tracedir (defaults to the tracedir given to enable) by any process.
+    """
+    tracedir = _state['tracedir'] if tracedir is None else tracedir
+    _check_fork()
+    allevents = list(_events)
+    if tracedir is not None:
+        for fname in sorted(glob.glob(os.path.join(tracedir, 'trace_*.jsonl'))):
+            with open(fname) as f:
+                allevents.extend([json.loads(line) for line in f if line.strip()])
+    return allevents
+
+
+def export_chrome(filename, events_ = None):
+    """
+    Writes events_ (defaults to events()) to filename in the Chrome trace json format.
+    """
+    if events_ is None:
+        events_ = events()
+    with open(filename, 'w') as f:
+        json.dump({'traceEvents': events_, 'displayTimeUnit': 'ms'}, f)
+
+
+def summary(events_ = None):
+    """
+    Aggregates the spans in events_ (defaults to events()) by name, and prints them as a table sorted by total time.
+
+    Gives
+    list of dicts with keys 'name', 'count', 'total', 'mean' and 'max' (seconds), sorted by total.
+    """
+    if events_ is None:
+        events_ = events()
+    durations = {}
+    for event in events_:
+        if event['ph'] == 'X':
+            durations.setdefault(event['name'], []).append(event['dur'] / 1e6)
+    results = [{'name': name, 'count': len(d), 'total': sum(d), 'mean': sum(d) / len(d), 'max': max(d)} for name, d in durations.items()]
+    results.sort(key = lambda r: r['total'], reverse = True)
+
+    print "{:<36} {:>8} {:>12} {:>12} {:>12}".format('span', 'count', 'total (s)', 'mean (ms)', 'max (ms)')
+    for r in results:
+        print "{:<36} {:>8} {:>12.3f} {:>12.2f} {:>12.2f}".format(r['name'], r['count'], r['total'], 1000 * r['mean'], 1000 * r['max'])
+    return results
@@ -0,0 +1,246 @@
+"""
+unit_tests contains behavior checks for the numpy parts of beijbom_lib, that run without caffe or data. The notebook (unit_tests.ipynb) holds the interactive tests that need trained nets.
+
+Usage
+python unit_tests.py            # runs all test_ functions.
+python unit_tests.py psave      # runs the test_ functions whose name contains psave.
+"""
+
+import os, sys, shutil, tempfile, traceback
+import numpy as np
+
+import beijbom_misc_tools as bmt
+
+
+def _tmpdir():
+    return tempfile.mkdtemp(prefix = 'beijbom_unit_tests_')
+
+
+def test_psave_roundtrip():
+    structured = np.zeros(4, dtype = [('x', '<i4'), ('y', '<f8')])
+    structured['y'] = [1, 2, 3, 4]
+    var = {'plain': np.arange(12.).reshape(3, 4), 'structured': structured, 'zerod': np.array(3.5), 'fortran': np.asfortranarray(np.arange(6).reshape(2, 3)),
+        'scores': [np.random.rand(5) for _ in range(3)], 'masked': np.ma.array([1, 2, 3], mask = [0, 1, 0]), 'other': ('a', 1)}
+    tmpdir = _tmpdir()
+    try:
+        for compress in [False, True]:
+            for mmap_mode in [None, 'r']:
+                bmt.psave(var, os.path.join(tmpdir, 'var.p'), compress = compress)
+                loaded = bmt.pload(os.path.join(tmpdir, 'var.p'), mmap_mode = mmap_mode)
+                for key in ['plain', 'structured', 'zerod', 'fortran']:
+                    assert loaded[key].dtype == var[key].dtype, key
+                    assert loaded[key].shape == var[key].shape, key
+                    assert np.array_equal(loaded[key], var[key]), key
+                assert np.array_equal(loaded['structured']['y'], [1, 2, 3, 4])
+                assert type(loaded['scores']) is list and np.allclose(loaded['scores'], var['scores'])
+                assert np.array_equal(loaded['masked'].mask, var['masked'].mask)
+                assert loaded['other'] == var['other']
+
+        # files without arrays are regular pickles.
+        bmt.psave({'a': 1}, os.path.join(tmpdir, 'plain.p'))
+        assert bmt.pload(os.path.join(tmpdir, 'plain.p')) == {'a': 1}
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def _random_labels(nclasses, n = 20000, seed = 0):
+    rand = np.random.RandomState(seed)
+    gt = rand.randint(0, nclasses, n)
+    est = np.where(rand.rand(n) < 0.6, gt, rand.randint(0, nclasses, n))
+    return (gt, est)
+
+
+def test_confmatrix_dense_sparse_parity():
+    from beijbom_confmatrix import ConfMatrix
+    # with few counts per entry, a sparse matrix stays sparse (it switches to dense once that is smaller).
+    (gt, est) = _random_labels(3000)
+    gt[:100] = 7 # ignored
+    (dense, sparse) = (ConfMatrix(3000, sparse = False), ConfMatrix(3000, sparse = True))
+    dense.add(gt, est, ignore_label = 7)
+    sparse.add(gt, est, ignore_label = 7, chunk_size = 1000)
+    assert sparse.sparse and not dense.sparse
+    assert np.array_equal(dense.cm, sparse.cm)
+    assert dense.total() == sparse.total() == np.sum(gt != 7)
+    assert np.allclose(dense.get_accuracy(), sparse.get_accuracy())
+    for metric in ['get_class_accuracy', 'get_class_recalls', 'get_class_precisions', 'get_class_f1s']:
+        assert np.allclose(getattr(dense, metric)(), getattr(sparse, metric)(), equal_nan = True), metric
+    (bdense, bsparse) = (dense.bootstrap(nboot = 50, seed = 1), sparse.bootstrap(nboot = 50, seed = 1))
+    for key in bdense:
+        for (d, s) in zip(bdense[key], bsparse[key]):
+            assert np.allclose(d, s, equal_nan = True), key
+    (acc, lower, upper) = bdense['accuracy']
+    assert lower <= acc <= upper
+
+
+def test_confmatrix_merge_and_serialize():
+    from beijbom_confmatrix import ConfMatrix
+    (gt, est) = _random_labels(3000)
+    full = ConfMatrix(3000)
+    full.add(gt, est)
+    parts = []
+    for (k, (start, stop)) in enumerate([(0, 5000), (5000, 12000), (12000, 20000)]):
+        part = ConfMatrix(3000, sparse = k % 2 == 1)
+        part.add(gt[start:stop], est[start:stop])
+        parts.append(part)
+    assert np.array_equal(sum(parts).cm, full.cm)
+    merged = ConfMatrix(3000, sparse = True)
+    for part in parts:
+        merged += part
+    assert np.array_equal(merged.cm, full.cm)
+
+    full.labelset = ['class{}'.format(k) for k in range(3000)]
+    for sparse in [False, True]:
+        loaded = ConfMatrix.frombytes(full.tobytes(), sparse = sparse)
+        assert loaded.sparse == sparse
+        assert np.array_equal(loaded.cm, full.cm)
+        assert list(loaded.labelset) == full.labelset
+    tmpdir = _tmpdir()
+    try:
+        merged.save(os.path.join(tmpdir, 'merged.cm'))
+        assert np.array_equal(ConfMatrix.load(os.path.join(tmpdir, 'merged.cm')).cm, full.cm)
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def test_feistel_permutation():
+    for n in [1, 2, 7, 100, 1000, 4097]:
+        for seed in [0, [3, 1]]:
+            perm = bmt.FeistelPermutation(n, seed)
+            assert sorted([perm(i) for i in range(n)]) == range(n), n
+    assert [bmt.FeistelPermutation(100, [3, 1])(i) for i in range(100)] != [bmt.FeistelPermutation(100, [3, 2])(i) for i in range(100)]
+
+
+def test_data_cursor_resume():
+    (n, batch_size) = (37, 5)
+    tmpdir = _tmpdir()
+    try:
+        cursorfile = os.path.join(tmpdir, 'data_cursor.json')
+        cursor = bmt.DataCursor(n, seed = 11, cursorfile = cursorfile)
+        stream = []
+        for _ in range(20):
+            (batch, rng) = cursor.next_batch()
+            stream.append((cursor.indices(batch * batch_size, batch_size), rng.rand(3)))
+
+        # each epoch visits every image once.
+        positions = sum([indices for (indices, _) in stream], [])
+        for epoch in range(len(positions) // n):
+            assert sorted(positions[epoch * n : (epoch + 1) * n]) == range(n)
+
+        # resuming mid-epoch (batch 9 starts at position 45 of epoch 1) continues the same stream, with the same augmentation draws.
+        bmt.DataCursor.set_batch(cursorfile, 9)
+        resumed = bmt.DataCursor(n, seed = 99, cursorfile = cursorfile) # the seed comes from the cursorfile.
+        for (indices, draws) in stream[9:]:
+            (batch, rng) = resumed.next_batch()
+            assert resumed.indices(batch * batch_size, batch_size) == indices
+            assert np.array_equal(rng.rand(3), draws)
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def test_int_to_rgb():
+    import colorsys
+    def reference(im, bg_color = 0, ignore = 255):
+        # the implementation before int_to_rgb used a lookup table.
+        gt_vals = np.setdiff1d(np.unique(im), ignore)
+        N = np.max(gt_vals) + 1
+        colors = 255 * np.array([colorsys.hsv_to_rgb(x * 1.0 / N, 0.5, 1) for x in range(N)])
+        ret = np.ones(im.shape + (3, ), dtype = np.uint8) * bg_color
+        for label in gt_vals:
+            ret[im == label] = colors[label, :]
+        return ret
+
+    rand = np.random.RandomState(0)
+    for nlabels in [2, 7, 20, 33]:
+        im = rand.randint(0, nlabels, (120, 90)).astype(np.uint8)
+        im[rand.rand(*im.shape) < 0.1] = 255
+        assert np.array_equal(bmt.int_to_rgb(im, chunk_rows = 7), reference(im)), nlabels
+        out = np.zeros(im.shape + (3, ), dtype = np.uint8)
+        bmt.int_to_rgb(im, out = out, chunk_rows = 50)
+        assert np.array_equal(out, reference(im)), nlabels
+
+
+def _serve(directory):
+    """
+    Starts a local keep-alive HTTP server for directory in a thread. Returns (server, base url, paths of the requests).
+    """
+    import threading, SocketServer, BaseHTTPServer, SimpleHTTPServer
+    requests = []
+
+    class Handler(SimpleHTTPServer.SimpleHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def translate_path(self, path):
+            return os.path.join(directory, path.split('?')[0].lstrip('/'))
+
+        def do_GET(self):
+            requests.append(self.path)
+            SimpleHTTPServer.SimpleHTTPRequestHandler.do_GET(self)
+
+        def log_message(self, *args):
+            pass
+
+    class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+        daemon_threads = True
+
+    server = Server(('127.0.0.1', 0), Handler)
+    thread = threading.Thread(target = server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return (server, 'http://127.0.0.1:{}/'.format(server.server_address[1]), requests)
+
+
+def test_image_source():
+    from PIL import Image
+    from beijbom_image_source import ImageSource
+    tmpdir = _tmpdir()
+    (server, url, requests) = _serve(tmpdir)
+    try:
+        images = [np.random.randint(0, 256, (40, 50, 3)).astype(np.uint8) for _ in range(4)]
+        for (k, im) in enumerate(images):
+            Image.fromarray(im).save(os.path.join(tmpdir, 'im{}.png'.format(k)))
+        urls = [url + 'im{}.png'.format(k) for k in range(4)]
+
+        # fetched once, then read from the cache.
+        source = ImageSource(os.path.join(tmpdir, 'cache'), nthreads = 2)
+        source.prefetch(urls)
+        for (im, u) in zip(images, urls):
+            assert np.array_equal(np.asarray(source.open(u)), im)
+        for (im, u) in zip(images, urls):
+            assert np.array_equal(np.asarray(source.open(u)), im)
+        assert len(requests) == 4
+
+        # a cache smaller than one image never evicts the image being opened, or the prefetched ones.
+        tiny = ImageSource(os.path.join(tmpdir, 'tiny'), cache_bytes = 10, nthreads = 2)
+        tiny.prefetch(urls)
+        for (im, u) in zip(images, urls):
+            assert np.array_equal(np.asarray(tiny.open(u)), im)
+        # once opened, they are evicted by the next fetch.
+        assert np.array_equal(np.asarray(tiny.open(urls[0] + '?again')), images[0])
+        assert len(os.listdir(os.path.join(tmpdir, 'tiny'))) == 1
+
+        assert source.open('file://' + os.path.join(tmpdir, 'im0.png')).size == (50, 40)
+        try:
+            source.open(url + 'missing.png')
+            assert False, 'missing image did not raise'
+        except IOError:
+            pass
+    finally:
+        server.shutdown()
+        server.server_close()
+        shutil.rmtree(tmpdir)
+
+
+if __name__ == '__main__':
+    pattern = sys.argv[1] if len(sys.argv) > 1 else ''
+    tests = [(name, func) for (name, func) in sorted(globals().items()) if name.startswith('test_') and pattern in name]
+    failed = []
+    for (name, func) in tests:
+        try:
+            func()
+            print "ok     {}".format(name)
+        except Exception:
+            failed.append(name)
+            print "FAILED {}".format(name)
+            traceback.print_exc()
+    print "{} passed, {} failed".format(len(tests) - len(failed), len(failed))
+    sys.exit(1 if failed else 0)